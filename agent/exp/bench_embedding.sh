@@ -0,0 +1,5 @@
+cd ../script
+python bench_embedding.py \
+--settings alibaba,baai,baai_bge_m3,qwen3,qwen3_small,tencent_conan,sentencetf \
+--threads 4 \
+--output_path ../results/retrieval/embedding_bakeoff.json
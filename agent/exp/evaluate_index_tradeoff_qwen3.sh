@@ -0,0 +1,13 @@
+cd ../script
+python build_faiss_idx.py \
+--model Qwen/Qwen3-Embedding-8B \
+--faiss_idx_path ../index/qwen3_faiss_ivfpq \
+--index_type ivfpq \
+--pq_m 64
+python evaluate.py \
+--setting qwen3 \
+--eval_type index_tradeoff \
+--faiss_idx_path ../index/qwen3_faiss_ivfpq \
+--baseline_idx_path ../index/qwen3_faiss \
+--sweep 1,4,16,64,256 \
+--output_path ../results/retrieval/index_tradeoff_qwen3_ivfpq.csv
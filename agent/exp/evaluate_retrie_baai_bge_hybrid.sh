@@ -0,0 +1,9 @@
+cd ../script
+python build_faiss_idx.py \
+--model BAAI/bge-m3 \
+--faiss_idx_path ../index/baai_bge_m3_faiss
+python build_sparse_vec.py \
+--sparse_idx_path ../index/bm25_512
+python evaluate.py \
+--setting baai_bge_m3_hybrid \
+--eval_type retrieval
@@ -0,0 +1,5 @@
+cd ../script
+python evaluate.py \
+--setting baai_bge_m3_rerank \
+--eval_type retrieval \
+--output_path ../results/retrieval/evaluation_results_baai_bge_m3_rerank.csv
@@ -0,0 +1,6 @@
+cd ../script
+python evaluate.py \
+--eval_type retrieval_batch \
+--settings alibaba,baai,baai_bge_m3,baai_bge_m3_hybrid,qwen3_small,tencent_conan,sentencetf \
+--ks 1,3,5,10 \
+--output_path ../results/retrieval/evaluation_results_batch.csv
@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import multiprocessing
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, project_root)
+
+import numpy as np
+import pandas as pd
+
+from utils.rag import create_emb, doc_store, process_faiss_idx
+
+# params.py 中的 embedding 設定
+EMB_SETTINGS = ["alibaba", "baai", "baai_bge_m3", "qwen3", "qwen3_small", "tencent_conan", "sentencetf"]
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="Compare embedding models: cost (CPU latency, memory) and retrieval quality")
+    parser.add_argument(
+        "--settings",
+        type=str,
+        default=",".join(EMB_SETTINGS),
+        help="Comma-separated settings (rag_main.get_params) to benchmark"
+    )
+    parser.add_argument(
+        "--benchmark_dir",
+        type=str,
+        default="../data/eval/retrieval",
+        help="Directory to the retrieval benchmark"
+    )
+    parser.add_argument(
+        "--output_path",
+        type=str,
+        default="../results/retrieval/embedding_bakeoff.json",
+        help="Path to save the comparison (JSON; a CSV with the same name is written too)"
+    )
+    parser.add_argument(
+        "--ks",
+        type=str,
+        default="1,3,5,10",
+        help="Comma-separated cutoffs for Recall@k / nDCG@k"
+    )
+    parser.add_argument(
+        "--n_corpus",
+        type=int,
+        default=512,
+        help="Number of indexed chunks encoded to measure corpus throughput"
+    )
+    parser.add_argument(
+        "--n_queries",
+        type=int,
+        default=200,
+        help="Number of questions encoded / searched one by one for latency percentiles"
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=32,
+        help="Corpus encode batch size"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="torch CPU threads (match the serving machine; default: torch default)"
+    )
+    return parser
+
+
+def peak_rss_mb() -> float:
+    # Linux 的 ru_maxrss 單位為 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def percentiles_ms(latencies: list) -> dict:
+    latencies = np.asarray(latencies) * 1000
+    return {"p50": float(np.percentile(latencies, 50)), "p95": float(np.percentile(latencies, 95))}
+
+def dir_size_mb(path: str) -> float:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path) for name in names
+    ) / 2 ** 20
+
+
+def bench_setting(setting: str, args: argparse.Namespace) -> dict:
+    """
+    Benchmark one setting. Runs in its own process, so load time and peak RSS
+    are not affected by models benchmarked before it.
+    """
+    import torch
+    from rag_main import get_params
+    from evaluate import hit_rank, load_retrieval_queries, ranking_metrics
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    params = get_params(setting)
+    ks = sorted(int(k) for k in args.ks.split(",") if k)
+    queries = load_retrieval_queries(args.benchmark_dir)
+    questions = queries["question"].tolist()
+    row = {"setting": setting, "emb_model": params.emb_model, "faiss_idx_path": params.faiss_idx_path}
+    rss_start = peak_rss_mb()
+
+    # 1) 載入模型
+    start = time.perf_counter()
+    embeddings = create_emb.get_embedding_model(params.emb_model, cache_size=0)
+    row["load_s"] = time.perf_counter() - start
+    row["model_rss_mb"] = peak_rss_mb() - rss_start
+
+    # 2) 單筆 query encode latency（不經過快取）
+    latencies = []
+    for question in questions[:args.n_queries]:
+        start = time.perf_counter()
+        embeddings.base.embed_query(question)
+        latencies.append(time.perf_counter() - start)
+    if latencies:
+        row.update({f"query_encode_{p}_ms": v for p, v in percentiles_ms(latencies).items()})
+
+    if not os.path.exists(os.path.join(params.faiss_idx_path, "index.faiss")):
+        print(f"[WARN] {params.faiss_idx_path} not found; skipped corpus / search / retrieval metrics")
+        row["peak_rss_mb"] = peak_rss_mb()
+        return row
+
+    # 3) corpus encode throughput（index 中實際的 chunk）
+    if doc_store.has_doc_store(params.faiss_idx_path):
+        records = doc_store.iter_records(params.faiss_idx_path)
+        texts = [r["page_content"] for _, r in zip(range(args.n_corpus), records)]
+    else:
+        texts = []  # 舊版 index.pkl，需先 --migrate
+    if texts:
+        start = time.perf_counter()
+        create_emb.encode_documents(embeddings, texts, batch_size=args.batch_size)
+        row["corpus_chunks_per_s"] = len(texts) / (time.perf_counter() - start)
+
+    # 4) FAISS 搜尋 latency 與 index 大小
+    vectorstore = process_faiss_idx.load_index(
+        params.faiss_idx_path, embeddings,
+        nprobe=params.nprobe, ef_search=params.ef_search, use_mmap=params.mmap_index,
+    )
+    row["index_size_mb"] = dir_size_mb(params.faiss_idx_path)
+    row["n_vectors"] = vectorstore.index.ntotal
+
+    vectors = np.asarray(embeddings.embed_queries(questions), dtype=np.float32)
+    latencies = []
+    for vector in vectors[:args.n_queries]:
+        start = time.perf_counter()
+        vectorstore.similarity_search_by_vector(vector.tolist(), k=params.k)
+        latencies.append(time.perf_counter() - start)
+    if latencies:
+        row.update({f"search_{p}_ms": v for p, v in percentiles_ms(latencies).items()})
+
+    # 5) retrieval 品質（與 evaluate.py --eval_type retrieval_batch 相同的指標）
+    results = process_faiss_idx.search_batch(vectorstore, vectors, max(ks))
+    ranks = [hit_rank(docs, gt) for docs, gt in zip(results, queries["uuid"])]
+    row.update(ranking_metrics(ranks, ks))
+
+    row["peak_rss_mb"] = peak_rss_mb()
+    return row
+
+
+def run_isolated(setting: str, args: argparse.Namespace) -> dict:
+    # 每個模型在新的 process 中量測
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1) as pool:
+        try:
+            return pool.apply(bench_setting, (setting, args))
+        except Exception as e:
+            print(f"[ERROR] {setting}: {e}")
+            return {"setting": setting, "error": str(e)}
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+
+    rows = []
+    for setting in [s for s in args.settings.split(",") if s]:
+        print(f"=== {setting} ===")
+        row = run_isolated(setting, args)
+        print(json.dumps(row, ensure_ascii=False, indent=2))
+        rows.append(row)
+
+    os.makedirs(os.path.dirname(args.output_path), exist_ok=True)
+    with open(args.output_path, "w", encoding="utf-8") as f:
+        json.dump(rows, f, ensure_ascii=False, indent=2)
+    df = pd.DataFrame(rows)
+    df.to_csv(os.path.splitext(args.output_path)[0] + ".csv", index=False)
+
+    print("\n--- Embedding model comparison ---")
+    print(df.drop(columns=["faiss_idx_path"], errors="ignore").to_string(index=False, float_format=lambda x: f"{x:.3f}"))
@@ -8,7 +8,7 @@ import tempfile
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.insert(0, project_root)
 
-from utils.rag import create_emb, process_faiss_idx, common_utils
+from utils.rag import create_emb, process_faiss_idx, common_utils, sparse_idx
 from utils.google_cloud_api.google_drive_api import get_files_in_folder
 
 def create_parser():
@@ -41,20 +41,178 @@ def create_parser():
         default="../index/alibaba_faiss",
         help="Output path to save FAISS index"
     )
+
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=32,
+        help="Encode batch size (chunks are length-sorted to minimize padding)"
+    )
+
+    parser.add_argument(
+        "--encode_workers",
+        type=int,
+        default=1,
+        help="Number of CPU processes for corpus embedding"
+    )
+
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=0,
+        help="Checkpoint embeddings every N chunks so an interrupted build can resume (0: disabled)"
+    )
+
+    parser.add_argument(
+        "--keep_shards",
+        action="store_true",
+        help="Keep the shard checkpoints after the index is built"
+    )
+
+    parser.add_argument(
+        "--load_workers",
+        type=int,
+        default=1,
+        help="Number of processes parsing data files in parallel"
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only embed added/changed chunks and delete stale ones (tracked by files.json in the index)"
+    )
+
+    parser.add_argument(
+        "--sparse_idx_path",
+        type=str,
+        default=None,
+        help="Also rebuild the BM25 sparse index from the same chunks (keeps hybrid retrieval in sync, e.g. with --incremental)"
+    )
+
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="Rewrite an index saved with the old pickled docstore (index.pkl) in the current format"
+    )
+
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Merge exact and near-duplicate chunks before indexing (not applied with --incremental)"
+    )
+
+    parser.add_argument(
+        "--dedup_threshold",
+        type=float,
+        default=0.97,
+        help="Cosine similarity above which two chunks are treated as near-duplicates"
+    )
+
+    parser.add_argument(
+        "--index_type",
+        type=str,
+        default="flat",
+        choices=process_faiss_idx.INDEX_TYPES,
+        help="FAISS index type: exact flat, or approximate ivf / hnsw / pq / ivfpq"
+    )
+
+    parser.add_argument(
+        "--metric",
+        type=str,
+        default="l2",
+        choices=["l2", "ip"],
+        help="l2, or ip (inner product on normalized vectors = cosine)"
+    )
+
+    parser.add_argument(
+        "--nlist",
+        type=int,
+        default=0,
+        help="Number of IVF lists (0: 4 * sqrt(n_chunks))"
+    )
+
+    parser.add_argument(
+        "--pq_m",
+        type=int,
+        default=16,
+        help="Number of PQ sub-quantizers (must divide the embedding dimension)"
+    )
+
+    parser.add_argument(
+        "--hnsw_m",
+        type=int,
+        default=32,
+        help="Number of HNSW neighbors per node"
+    )
+
+    parser.add_argument(
+        "--train_size",
+        type=int,
+        default=50000,
+        help="Max number of vectors sampled to train IVF / PQ"
+    )
     return parser
 
 if __name__ == "__main__":
     parser = create_parser()
     args = parser.parse_args()
+    if args.incremental and args.index_type != "flat":
+        # HNSW 不支援 remove_ids；IVF / PQ 刪除後保留原 label，會與 docstore id 對應錯亂
+        parser.error(f"--incremental only supports --index_type flat, not {args.index_type}")
 
     # get files in data directory
     data_dir = os.path.join(project_root, args.doc_path)
     files = common_utils.list_all_files(data_dir)
 
-    # load documents from files
-    docs = process_faiss_idx.load_doc(files)
-    all_split = process_faiss_idx.split(docs, chunk_size=args.chunk_size)
-
-    # build FAISS index
     embedding_model = create_emb.get_embedding_model(args.model)
-    process_faiss_idx.build_new_index(all_split, args.faiss_idx_path, embedding_model)
\ No newline at end of file
+    dedup_threshold = args.dedup_threshold if args.dedup else None
+    index_spec = process_faiss_idx.IndexSpec(
+        index_type=args.index_type,
+        metric=args.metric,
+        nlist=args.nlist,
+        pq_m=args.pq_m,
+        hnsw_m=args.hnsw_m,
+        train_size=args.train_size,
+    )
+    if args.migrate:
+        process_faiss_idx.migrate_index(args.faiss_idx_path, embedding_model)
+    elif args.incremental:
+        process_faiss_idx.update_index(
+            files, args.faiss_idx_path, embedding_model,
+            chunk_size=args.chunk_size,
+            batch_size=args.batch_size,
+            n_workers=args.encode_workers,
+            index_spec=index_spec,
+        )
+    elif args.shard_size > 0:
+        # streaming: files -> rows -> documents -> chunks -> shards，記憶體只保留一個 shard
+        docs = process_faiss_idx.iter_docs(files, n_workers=args.load_workers)
+        chunks = process_faiss_idx.iter_chunks(docs, chunk_size=args.chunk_size)
+        process_faiss_idx.build_new_index_sharded(
+            chunks, args.faiss_idx_path, embedding_model,
+            shard_size=args.shard_size,
+            batch_size=args.batch_size,
+            n_workers=args.encode_workers,
+            keep_shards=args.keep_shards,
+            dedup_threshold=dedup_threshold,
+            index_spec=index_spec,
+        )
+    else:
+        # streaming: files -> documents -> chunks -> index，不保留完整的文件與 chunk 清單
+        docs = process_faiss_idx.iter_docs(files, n_workers=args.load_workers)
+        chunks = process_faiss_idx.iter_chunks(docs, chunk_size=args.chunk_size)
+
+        # build FAISS index
+        process_faiss_idx.build_new_index(
+            chunks, args.faiss_idx_path, embedding_model,
+            batch_size=args.batch_size,
+            n_workers=args.encode_workers,
+            dedup_threshold=dedup_threshold,
+            index_spec=index_spec,
+        )
+
+    if args.sparse_idx_path and not args.migrate:
+        # BM25 只需斷詞、不需 embedding：每次從全部檔案重建，與 FAISS 的 chunk 一致
+        docs = process_faiss_idx.iter_docs(files, n_workers=args.load_workers)
+        chunks = process_faiss_idx.iter_chunks(docs, chunk_size=args.chunk_size)
+        sparse_idx.build_sparse_index(chunks, args.sparse_idx_path)
@@ -5,12 +5,10 @@ import sys
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.insert(0, project_root)
 
-from langchain_community.retrievers import BM25Retriever
-
-from utils.rag import create_emb, process_faiss_idx, common_utils
+from utils.rag import process_faiss_idx, common_utils, sparse_idx
 
 def create_parser():
-    parser = argparse.ArgumentParser(description="Build FAISS index from JSON passages")
+    parser = argparse.ArgumentParser(description="Build BM25 sparse index from the same chunks as the FAISS index")
 
     parser.add_argument(
         "--doc_path",
@@ -18,6 +16,20 @@ def create_parser():
         default="data/docs",
         help="Path to retrival file containing raw text passages"
     )
+
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=512,
+        help="Size of text chunks to split documents into (same as build_faiss_idx.py)"
+    )
+
+    parser.add_argument(
+        "--sparse_idx_path",
+        type=str,
+        default="../index/bm25_512",
+        help="Output path to save the sparse index"
+    )
     return parser
 
 if __name__ == "__main__":
@@ -28,7 +40,10 @@ if __name__ == "__main__":
     # get files in data directory
     data_dir = os.path.join(project_root, args.doc_path)
     files = common_utils.list_all_files(data_dir)
-    print(files)
 
-    # 建立 BM25Retriever, input list[str]
-    #retriever = BM25Retriever.from_texts(docs)
\ No newline at end of file
+    # stream documents from files, split exactly like build_faiss_idx.py
+    docs = process_faiss_idx.iter_docs(files)
+    chunks = process_faiss_idx.iter_chunks(docs, chunk_size=args.chunk_size)
+
+    # 建立 BM25 sparse index (中文斷詞)
+    sparse_idx.build_sparse_index(chunks, args.sparse_idx_path)
@@ -1,7 +1,10 @@
 import os
 import sys
-import time
 import json
+import hashlib
+import argparse
+import threading
+from typing import Iterator
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -10,62 +13,119 @@ project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.insert(0, project_root)
 
 from params import ChatbotParams
-from utils.rag.build_rag import chat_with_rag, chat_without_rag, chat_with_rag_style
+from rag_main import get_api_key
+from utils.rag import tracing
+from utils.rag.chain_registry import ChainRegistry
+from utils.rpc.socket_rpc import DEFAULT_SOCKET_PATH, create_server
+
+PARAMS_PATH = "params.json"
+
+# 整個 process 共用：embedding model / FAISS index / chain 只載入一次
+registry = ChainRegistry()
+_params_state = {"mtime": None, "digest": None, "params": None}
+_params_lock = threading.Lock()
+
+@tracing.traced("config_read")
+def load_params(path: str = PARAMS_PATH) -> ChatbotParams:
+    """
+    Load ChatbotParams from params.json, re-reading the file only when it changed
+    (mtime first, then content hash).
+    """
+    with _params_lock:
+        mtime = os.stat(path).st_mtime_ns
+        if mtime == _params_state["mtime"]:
+            return _params_state["params"]
+
+        with open(path, "rb") as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw).hexdigest()
+        if digest != _params_state["digest"]:
+            cfg = json.loads(raw.decode("utf-8"))
+            params = ChatbotParams.from_dict(cfg)
+            # openrouter_api_key_id 未設定時為 None：請求分散到所有設定的 OpenRouter key
+            params.openrouter_api_key = get_api_key(params.openrouter_api_key_id)
+            _params_state["params"] = params
+            _params_state["digest"] = digest
+        _params_state["mtime"] = mtime
+        return _params_state["params"]
 
 def update_param(chatbot_model: str = None, with_rag: bool = None, with_style: bool = None) -> None:
     """
     Update the chatbot parameters stored in params.json
     """
 
-    # 讀取現有的 JSON
-    with open("params.json", "r", encoding="utf-8") as f:
-        cfg = json.load(f)
+    with _params_lock:
+        # 讀取現有的 JSON
+        with open(PARAMS_PATH, "r", encoding="utf-8") as f:
+            cfg = json.load(f)
 
-    # 更新指定的 key
-    if chatbot_model is not None:
-        cfg["chatbot_model"] = chatbot_model
-    if with_rag is not None:
-        cfg["with_rag"] = with_rag
-    if with_style is not None:
-        cfg["with_style"] = with_style
+        # 更新指定的 key
+        if chatbot_model is not None:
+            cfg["chatbot_model"] = chatbot_model
+        if with_rag is not None:
+            cfg["with_rag"] = with_rag
+        if with_style is not None:
+            cfg["with_style"] = with_style
 
-    # 寫回 JSON 檔
-    with open("params.json", "w", encoding="utf-8") as f:
-        json.dump(cfg, f, indent=4, ensure_ascii=False)
+        # 寫回 JSON 檔
+        with open(PARAMS_PATH, "w", encoding="utf-8") as f:
+            json.dump(cfg, f, indent=4, ensure_ascii=False)
 
     return
 
-def ask_with_chatbot(query: str) -> str:
-    with open("params.json", "r", encoding="utf-8") as f:
-            cfg = json.load(f)
+def get_chain_input(params: ChatbotParams, query: str, session_id: str, trace: object) -> tuple:
+    """
+    Input and config for the chain of `params`; multi-turn chains keep one history per session (chat id).
+    """
+    config = {"callbacks": [trace.callback()]}
+    if params.with_rag and params.multiturn:
+        config["configurable"] = {"session_id": session_id or "default"}
+        return {"question": query}, config
+    return query, config
 
-    params = ChatbotParams(
-        emb_model=cfg["emb_model"],
-        faiss_idx_path=cfg["faiss_idx_path"],
-        k=cfg["k"],
-        chatbot_model=cfg["chatbot_model"],
-        judge_model=cfg["judge_model"],
-        with_rag=cfg["with_rag"],
-        with_style=cfg["with_style"],
-        openrouter_api_key=os.getenv("OPENROUTER_API_KEY"),
-    )
-
-    if params.with_rag:
-        if cfg["with_style"]:
-            rag_chain = chat_with_rag_style(params)
-        else:
-            rag_chain = chat_with_rag(params)
-        reply = rag_chain.invoke(query)
-        print(f"Reply: {reply}")
-    else:
-        worag_chain = chat_without_rag(params)
-        reply = worag_chain.invoke(query)
-        print(f"Reply: {reply}")
+def ask_with_chatbot(query: str, session_id: str = None) -> str:
+    with tracing.request("chat", stream=False) as trace:
+        params = load_params()
+        chain = registry.get_chain(params)
+        chain_input, config = get_chain_input(params, query, session_id, trace)
+        reply = chain.invoke(chain_input, config=config)
+    print(f"Reply: {reply}")
 
     return reply
 
-def tackle_msg(msg: str) -> None:
-    if msg == "/close_rag":
+def stream_with_chatbot(query: str, session_id: str = None) -> Iterator[str]:
+    """
+    Yield the reply token by token as the LLM generates it.
+    """
+    pieces = []
+    with tracing.request("chat", stream=True) as trace:
+        params = load_params()
+        chain = registry.get_chain(params)
+        chain_input, config = get_chain_input(params, query, session_id, trace)
+        for piece in chain.stream(chain_input, config=config):
+            pieces.append(piece)
+            yield piece
+    print(f"Reply: {''.join(pieces)}")
+
+def stream_msg(msg: str, session_id: str = None) -> Iterator[str]:
+    # 指令不需要串流，直接回傳結果
+    if msg.startswith("/"):
+        yield tackle_msg(msg, session_id)
+    else:
+        yield from stream_with_chatbot(msg, session_id)
+
+def tackle_msg(msg: str, session_id: str = None) -> None:
+    if msg == "/reset":
+        # 清除這個 chat 的多輪對話紀錄
+        try:
+            params = load_params()
+            # 未啟用多輪對話時沒有紀錄可清除，不建立 session store
+            if params.with_rag and params.multiturn:
+                registry.get_session_store(params).clear(session_id or "default")
+            reply = "Success"
+        except Exception as e:
+            reply = "Failed"
+    elif msg == "/close_rag":
         try:
             update_param(with_rag=False)
             reply = "Success"
@@ -91,20 +151,51 @@ def tackle_msg(msg: str) -> None:
         except Exception as e:
             reply = "Failed"
     else:
-        reply = ask_with_chatbot(msg)
+        reply = ask_with_chatbot(msg, session_id)
     return reply
 
+def create_parser():
+    parser = argparse.ArgumentParser(description="Telegram chatbot backend")
+    parser.add_argument(
+        "--socket_path",
+        type=str,
+        default=DEFAULT_SOCKET_PATH,
+        help="Unix-domain socket shared with telegram_frontend.py"
+    )
+    parser.add_argument(
+        "--index_poll_interval",
+        type=float,
+        default=10.0,
+        help="Seconds between checks for a rebuilt FAISS index (hot reload)"
+    )
+    parser.add_argument(
+        "--trace_jsonl",
+        type=str,
+        default=os.getenv("TRACE_JSONL_PATH"),
+        help="Append per-request stage timings to this JSONL file"
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=int(os.getenv("METRICS_PORT", "0")),
+        help="Serve Prometheus metrics on http://127.0.0.1:<port>/metrics (0 to disable)"
+    )
+    return parser
+
 if __name__ == "__main__":
-    while True:
-        i_path = "../../msg.txt"
-        o_path = "../../msg2.txt"
-        if os.path.exists(i_path):
-            with open(i_path) as f:
-                msg = f.read().strip()
-            print(f"Received message: {msg}")
-            if msg:
-                reply = tackle_msg(msg)
-                with open(o_path, "w") as f:
-                    f.write(reply)
-                os.remove(i_path)  # 清掉舊訊息
-        time.sleep(1)
\ No newline at end of file
+    args = create_parser().parse_args()
+
+    # 每個請求各階段的耗時 (config 讀取、embedding、FAISS、LLM ...)
+    tracing.configure(args.trace_jsonl)
+    if args.metrics_port:
+        tracing.start_metrics_server(args.metrics_port)
+
+    # 啟動時先載入 embedding model 與 FAISS index
+    registry.warm_up(load_params())
+    # index 重建後在背景載入並替換，不需重啟
+    registry.start_index_watcher(args.index_poll_interval)
+
+    # 每個連線由獨立 thread 處理，多個使用者可同時發問
+    with create_server(tackle_msg, args.socket_path, stream_msg=stream_msg) as server:
+        print(f"Backend listening on {args.socket_path}")
+        server.serve_forever()
@@ -1,8 +1,11 @@
 import os
+import dataclasses
 from dotenv import load_dotenv
 load_dotenv()
 
+import asyncio
 import argparse
+import numpy as np
 import pandas as pd
 import time
 from tqdm import tqdm
@@ -12,8 +15,14 @@ from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
 from langchain_openai import ChatOpenAI
 
-from rag_main import get_params
-from utils.rag.build_rag import chat_without_rag, chat_with_rag, get_retriever
+from rag_main import get_api_key, get_params
+from utils.rag import create_emb, llm_client, process_faiss_idx
+from utils.rag.build_rag import (
+    chat_without_rag, chat_with_rag, get_hybrid_retriever, get_rerank_retriever,
+    get_retriever, get_retriever_embeddings, load_vectorstore,
+)
+from utils.rag.rerank import CrossEncoderReranker
+from utils.rag.gen_eval import GenerationEvaluator
 from params import PARAMS_ALIBABA, PARAMS_ALIBABA_WORAG, PARAMS_SENTENCE
 
 def create_parser():
@@ -48,16 +57,74 @@ def create_parser():
         default="generation",
         help="Type of evaluation to perform"
     )
+    parser.add_argument(
+        "--emb_cache_path",
+        type=str,
+        default="../cache/query_emb.sqlite",
+        help="SQLite file caching query embeddings across runs (empty string to disable)"
+    )
     parser.add_argument(
         "--openrouter_setting",
         type=int,
-        default=0,
+        default=None,
         choices=[0, 1],
-        help="OpenRouter setting: 0 for default, 1 for alternative"
+        help="OpenRouter setting: 0 for default, 1 for alternative (default: balance over all configured keys)"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="[generation] Max questions evaluated concurrently"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0.3,
+        help="[generation] Max OpenRouter requests per second per API key (halved on every 429, then recovers)"
+    )
+    parser.add_argument(
+        "--settings",
+        type=str,
+        default=None,
+        help="[retrieval_batch] Comma-separated settings to compare (default: --setting)"
+    )
+    parser.add_argument(
+        "--ks",
+        type=str,
+        default="1,3,5,10",
+        help="[retrieval_batch] Comma-separated cutoffs for Recall@k / nDCG@k"
+    )
+    parser.add_argument(
+        "--faiss_idx_path",
+        type=str,
+        default=None,
+        help="Override the FAISS index of the setting (e.g. an approximate index built with --index_type)"
+    )
+    parser.add_argument(
+        "--baseline_idx_path",
+        type=str,
+        default=None,
+        help="[index_tradeoff] Exact (flat) index built from the same chunks, used as the recall baseline"
+    )
+    parser.add_argument(
+        "--sweep",
+        type=str,
+        default="1,4,16,64,256",
+        help="[index_tradeoff] Comma-separated nprobe (IVF) / efSearch (HNSW) values to evaluate"
     )
     return parser
 
 
+def hit_rank(docs: List[Document], gt_uuid: str) -> Any:
+    """
+    1-based rank of the first retrieved chunk from document `gt_uuid` (None if missed).
+    """
+    for rank, doc in enumerate(docs, start=1):
+        # 去重後的 chunk 會在 metadata["uuids"] 記錄所有合併進來的文件
+        if gt_uuid in (doc.metadata.get("uuids") or [doc.metadata.get("uuid")]):
+            return rank
+    return None
+
 def eval_retrie_unit(file_path: str, retriever: object, k: int) -> Tuple[List[Dict[str, Any]], int, int]:
     """
     回傳: (results, n_correct, n_total)
@@ -82,12 +149,11 @@ def eval_retrie_unit(file_path: str, retriever: object, k: int) -> Tuple[List[Di
         retrieved_id = [doc.metadata.get("uuid") for doc in docs]
 
         # 是否命中 + 排名（1-based；未命中為 None）
-        if gt_source in retrieved_id:
-            rank = retrieved_id.index(gt_source) + 1
+        rank = hit_rank(docs, gt_source)
+        if rank is not None:
             n_correct += 1
             is_correct = True
         else:
-            rank = None
             is_correct = False
 
         results.append({
@@ -101,19 +167,28 @@ def eval_retrie_unit(file_path: str, retriever: object, k: int) -> Tuple[List[Di
 
     return results, n_correct, len(gt_data)
 
-def evaluate_retrieval(benchmark_dir: str, output_path: str, params: object):
-    # 建立 retriever
-    retriever = get_retriever(params.faiss_idx_path, params.emb_model, params.k)
-    k = params.k
-
+def get_retrieval_eval_files(benchmark_dir: str) -> List[str]:
     # 要評估的檔案清單（可依需求增減）
-    eval_files = [
+    return [
         os.path.join(benchmark_dir, "faq.csv"),
         os.path.join(benchmark_dir, "faq_rephrased_full.csv"),
         os.path.join(benchmark_dir, "military_questions.csv"),
         os.path.join(benchmark_dir, "usrexp.csv"),
     ]
 
+def evaluate_retrieval(benchmark_dir: str, output_path: str, params: object):
+    # 建立 retriever
+    retriever = get_retriever(
+        params.faiss_idx_path, params.emb_model, params.k, params.emb_cache_path,
+        params.sparse_idx_path, params.dense_weight,
+        nprobe=params.nprobe, ef_search=params.ef_search, use_mmap=params.mmap_index,
+        rerank_model=params.rerank_model, rerank_fetch_k=params.rerank_fetch_k,
+        rerank_budget_ms=params.rerank_budget_ms,
+    )
+    k = params.k
+
+    eval_files = get_retrieval_eval_files(benchmark_dir)
+
     all_rows: List[Dict[str, Any]] = []
     total_correct = 0
     total_count = 0
@@ -140,6 +215,7 @@ def evaluate_retrieval(benchmark_dir: str, output_path: str, params: object):
     print(f"Total evaluated samples: {total_count}")
     print(f"Correctly retrieved count: {total_correct}")
     print(f"Precision@{k}: {precision_at_k:.4f}")
+    print(f"Query embedding cache: {get_retriever_embeddings(retriever).stats()}")
 
     return {
         "precision_at_k": precision_at_k,
@@ -150,13 +226,232 @@ def evaluate_retrieval(benchmark_dir: str, output_path: str, params: object):
     }
 
 
-def get_llm_judger(chat_model: str, api_key: str) -> LLMChain:
-    llm = ChatOpenAI(
-        model=chat_model,
-        base_url="https://openrouter.ai/api/v1",
-        api_key=api_key,
-        temperature=0,
-    )
+def load_retrieval_queries(benchmark_dir: str) -> pd.DataFrame:
+    frames = []
+    for path in get_retrieval_eval_files(benchmark_dir):
+        if not os.path.exists(path):
+            print(f"[WARN] File not found, skipped: {path}")
+            continue
+        gt_data = pd.read_csv(path)[["question", "uuid"]]
+        gt_data["file"] = os.path.basename(path)
+        frames.append(gt_data)
+    if not frames:
+        return pd.DataFrame(columns=["question", "uuid", "file"])
+    return pd.concat(frames, ignore_index=True)
+
+def ranking_metrics(ranks: List[Any], ks: List[int]) -> Dict[str, float]:
+    """
+    Recall@k, nDCG@k and MRR@max(ks) from the 1-based rank of the ground-truth
+    document per question (None if missed). Each question has a single
+    relevant document, so Recall@k is the hit rate and the ideal DCG is 1.
+    """
+    ranks = np.array([r if r is not None else np.inf for r in ranks], dtype=float)
+    metrics = {}
+    for k in ks:
+        hit = ranks <= k
+        metrics[f"recall@{k}"] = hit.mean()
+        metrics[f"ndcg@{k}"] = np.where(hit, 1 / np.log2(np.minimum(ranks, k) + 1), 0.0).mean()
+    metrics[f"mrr@{max(ks)}"] = np.where(ranks <= max(ks), 1 / ranks, 0.0).mean()
+    return metrics
+
+def evaluate_retrieval_batch(
+    benchmark_dir: str,
+    output_path: str,
+    settings: List[str],
+    ks: List[int],
+    emb_cache_path: str = None,
+    faiss_idx_path: str = None,
+):
+    """
+    Retrieval benchmark for several settings in one run.
+
+    Per setting, the embedding model and index are loaded once, all questions
+    are embedded in one batched pass and searched with a single faiss call
+    (hybrid / rerank settings run the full retriever, on cached embeddings).
+    Reports Recall@k, nDCG@k and MRR per setting and per benchmark file.
+    """
+    queries = load_retrieval_queries(benchmark_dir)
+    if queries.empty:
+        print("[ERROR] No samples found. Nothing to evaluate.")
+        return None
+    questions = queries["question"].tolist()
+    max_k = max(ks)
+
+    embeddings_by_model = {}
+    rows = []
+    for setting in settings:
+        params = get_params(setting)
+        if faiss_idx_path:
+            params.faiss_idx_path = faiss_idx_path
+        print(f"=== {setting}: {params.emb_model} / {params.faiss_idx_path} ===")
+
+        if params.emb_model not in embeddings_by_model:
+            embeddings_by_model[params.emb_model] = create_emb.get_embedding_model(
+                params.emb_model, cache_size=len(questions), cache_path=emb_cache_path
+            )
+        embeddings = embeddings_by_model[params.emb_model]
+
+        start = time.perf_counter()
+        vectors = np.asarray(embeddings.embed_queries(questions), dtype=np.float32)
+        embed_s = time.perf_counter() - start
+
+        # 載入 index / BM25 / reranker 的時間與搜尋時間分開計算
+        start = time.perf_counter()
+        vectorstore = load_vectorstore(
+            params.faiss_idx_path, embeddings,
+            nprobe=params.nprobe, ef_search=params.ef_search, use_mmap=params.mmap_index,
+        )
+        retriever = None
+        if params.sparse_idx_path or params.rerank_model:
+            # 與 get_retriever 相同的組合；dense 檢索的 query embedding 已在快取中
+            fetch_k = max(params.rerank_fetch_k, max_k) if params.rerank_model else max_k
+            retriever = vectorstore.as_retriever(search_kwargs={"k": fetch_k})
+            if params.sparse_idx_path:
+                retriever = get_hybrid_retriever(retriever, params.sparse_idx_path, fetch_k, params.dense_weight)
+            if params.rerank_model:
+                retriever = get_rerank_retriever(
+                    retriever, CrossEncoderReranker(params.rerank_model), max_k, params.rerank_budget_ms
+                )
+        load_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if retriever is not None:
+            results = retriever.batch(questions)
+        else:
+            results = process_faiss_idx.search_batch(vectorstore, vectors, max_k)
+        search_s = time.perf_counter() - start
+
+        ranks = [hit_rank(docs[:max_k], gt) for docs, gt in zip(results, queries["uuid"])]
+        groups = [("all", np.arange(len(queries)))]
+        groups += [(name, np.flatnonzero(queries["file"] == name)) for name in queries["file"].unique()]
+        for name, idx in groups:
+            rows.append({
+                "setting": setting,
+                "file": name,
+                "n": len(idx),
+                **ranking_metrics([ranks[i] for i in idx], ks),
+                "embed_s": embed_s if name == "all" else None,
+                "load_s": load_s if name == "all" else None,
+                "search_s": search_s if name == "all" else None,
+            })
+
+    df = pd.DataFrame(rows)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    df.to_csv(output_path, index=False)
+    print("\n--- Summary ---")
+    print(df[df["file"] == "all"].drop(columns="file").to_string(index=False, float_format=lambda x: f"{x:.4f}"))
+    return df
+
+
+def evaluate_index_tradeoff(
+    benchmark_dir: str,
+    output_path: str,
+    params: object,
+    baseline_idx_path: str,
+    sweep: List[int],
+):
+    """
+    Recall-vs-latency of an approximate index (params.faiss_idx_path) against
+    the exact flat index it approximates, over the retrieval benchmark questions.
+
+    For every nprobe / efSearch value in `sweep`, reports recall@k against the
+    flat top-k, benchmark Precision@k and per-query search latency (embedding
+    excluded).
+
+    The baseline must be an exact flat index. If it is L2 and the candidate
+    uses inner product, the ground truth is recomputed with an exact
+    inner-product index over the baseline's vectors, so recall measures only
+    the approximation error, not the metric change.
+    """
+    k = params.k
+    embeddings = create_emb.get_embedding_model(params.emb_model, cache_path=params.emb_cache_path)
+
+    queries = []
+    for path in get_retrieval_eval_files(benchmark_dir):
+        if not os.path.exists(path):
+            print(f"[WARN] File not found, skipped: {path}")
+            continue
+        gt_data = pd.read_csv(path)
+        queries.extend(zip(gt_data["question"], gt_data["uuid"]))
+    if not queries:
+        print("[ERROR] No samples found. Nothing to evaluate.")
+        return None
+
+    # query embedding 只算一次，下面只量 index 搜尋時間
+    vectors = [embeddings.embed_query(q) for q, _ in tqdm(queries, desc="Embedding queries")]
+
+    def run(vectorstore):
+        latencies, results = [], []
+        for vector in vectors:
+            start = time.perf_counter()
+            docs = vectorstore.similarity_search_by_vector(vector, k=k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            results.append(docs)
+        return results, np.asarray(latencies)
+
+    def doc_key(doc):
+        return (doc.metadata.get("uuid"), doc.page_content)
+
+    def index_size_mb(index_dir):
+        return os.path.getsize(os.path.join(index_dir, "index.faiss")) / 2 ** 20
+
+    config = process_faiss_idx.load_index_config(params.faiss_idx_path)
+    baseline_config = process_faiss_idx.load_index_config(baseline_idx_path)
+    metric = config.get("metric", "l2")
+    baseline_metric = baseline_config.get("metric", "l2")
+    if baseline_config.get("index_type", "flat") != "flat":
+        raise ValueError(f"Baseline {baseline_idx_path} is not an exact flat index ({baseline_config.get('factory')})")
+
+    baseline = load_vectorstore(baseline_idx_path, embeddings)
+    if baseline_metric != metric:
+        if baseline_metric != "l2":
+            # ip baseline 只存正規化後的向量，無法還原 L2 的 ground truth
+            raise ValueError(
+                f"Baseline metric {baseline_metric} does not match candidate metric {metric}; "
+                f"build the baseline with --metric {metric}"
+            )
+        # 不同 metric 的 top-k 本來就不同：以 baseline 的原始向量建立相同 metric 的精確 index
+        print(f"[WARN] Baseline metric {baseline_metric} != candidate metric {metric}; using an exact {metric} index as ground truth")
+        baseline, _ = process_faiss_idx.convert_index(baseline, process_faiss_idx.IndexSpec(index_type="flat", metric=metric))
+    baseline_results, baseline_latencies = run(baseline)
+    baseline_keys = [{doc_key(d) for d in docs} for docs in baseline_results]
+
+    candidate = load_vectorstore(params.faiss_idx_path, embeddings)
+    settings = [(f"flat_{metric}", None, baseline_idx_path, baseline_results, baseline_latencies)]
+    for value in sweep:
+        process_faiss_idx.set_search_params(candidate.index, nprobe=value, ef_search=value)
+        results, latencies = run(candidate)
+        settings.append((config.get("factory", "Flat"), value, params.faiss_idx_path, results, latencies))
+
+    rows = []
+    for name, value, index_dir, results, latencies in settings:
+        recall = np.mean([
+            len({doc_key(d) for d in docs} & keys) / max(len(keys), 1)
+            for docs, keys in zip(results, baseline_keys)
+        ])
+        precision = np.mean([hit_rank(docs, gt) is not None for docs, (_, gt) in zip(results, queries)])
+        rows.append({
+            "index": name,
+            "nprobe_or_ef_search": value,
+            f"recall@{k}_vs_flat": recall,
+            f"precision@{k}": precision,
+            "mean_ms": latencies.mean(),
+            "p50_ms": np.percentile(latencies, 50),
+            "p95_ms": np.percentile(latencies, 95),
+            "index_size_mb": index_size_mb(index_dir),
+        })
+
+    df = pd.DataFrame(rows)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    df.to_csv(output_path, index=False)
+    print("\n--- Recall vs latency ---")
+    print(df.to_string(index=False, float_format=lambda x: f"{x:.4f}"))
+    return df
+
+
+def get_llm_judger(chat_model: str, api_key: str, max_retries: int = 2) -> LLMChain:
+    # judge 不做 fallback：換模型會讓評估標準不一致
+    llm = llm_client.get_chat_model(chat_model, api_key, temperature=0, max_retries=max_retries)
 
 
     # without ground truth
@@ -170,37 +465,18 @@ def get_llm_judger(chat_model: str, api_key: str) -> LLMChain:
     return LLMChain(llm=llm, prompt=prompt)
 
 # without ground truth
-def evaluate_gener_unit(file_path: str, chain_generation: object, llm_judger: object) -> None:
+def load_gener_unit(file_path: str) -> List[Dict[str, Any]]:
     df = pd.read_csv(file_path)
-    results = [] 
-    for i, row in tqdm(df.iterrows(), total=len(df)):
-        question = row["question"]
-
-        answer = chain_generation.invoke(question)
-        try:
-            result = llm_judger.run(question=question, answer=answer)
-        except Exception as e:
-            result = f"Error: {str(e)}"
-
-
-        print(f"[{i+1}] 問題: {question}")
-        print(f"回答: {answer}")
-        print(f"評估結果: {result}")
-        print("=" * 50)
-
-        results.append({
-            "question": question,
-            "answer": answer,
-            "evaluation": result
-        })
-
-        if (i + 1) % 4 == 0:
-            print("已完成 4 筆，休息 180 秒...")
-            time.sleep(180)
-
-    return results
-
-def evaluate_generation(benchmark_dir: str, output_path: str, params: object):
+    name = os.path.basename(file_path)
+    return [{"key": f"{name}:{i}", "question": row["question"]} for i, row in df.iterrows()]
+
+def evaluate_generation(
+    benchmark_dir: str,
+    output_path: str,
+    params: object,
+    concurrency: int = 4,
+    rate: float = 0.3,
+):
     # 要評估的檔案清單
     '''
     eval_files = [
@@ -213,6 +489,17 @@ def evaluate_generation(benchmark_dir: str, output_path: str, params: object):
         os.path.join(benchmark_dir, "military_questions.csv"),
     ]
 
+    # 429 由 GenerationEvaluator 統一退避重試，不使用 OpenAI client 的重試
+    # (複製一份：不要改到 get_params 共用的 preset)
+    params = dataclasses.replace(params, llm_max_retries=0)
+
+    # 使用 key pool 時，--rate 為每個 key 的速率
+    if params.openrouter_api_key is None:
+        n_keys = len(llm_client.get_key_pool())
+        if n_keys == 0:
+            raise ValueError("No OpenRouter API key configured (OPENROUTER_API_KEY / OPENROUTER_API_KEYS)")
+        rate *= n_keys
+
     # 建立 generation pipeline
     if params.with_rag:
         chain_generation = chat_with_rag(params)
@@ -220,22 +507,46 @@ def evaluate_generation(benchmark_dir: str, output_path: str, params: object):
         chain_generation = chat_without_rag(params)
 
     # 建立 LLM-judger
-    llm_judger = get_llm_judger(params.judge_model, params.openrouter_api_key)
+    llm_judger = get_llm_judger(params.judge_model, params.openrouter_api_key, max_retries=0)
 
-    # 對每一個檔案，對每一個問題進行評估
-    results_all = []
+    # 對每一個檔案，對每一個問題進行評估（並行、依 rate limit 調整速度；中斷後可從 checkpoint 繼續）
+    items = []
     for file in eval_files:
-        results = evaluate_gener_unit(file, chain_generation, llm_judger)
-        results_all.extend(results)
+        items.extend(load_gener_unit(file))
+    checkpoint_path = output_path + ".partial.jsonl"
+    evaluator = GenerationEvaluator(
+        chain_generation, llm_judger,
+        concurrency=concurrency,
+        rate=rate,
+        checkpoint_path=checkpoint_path,
+    )
+    records = asyncio.run(evaluator.evaluate(items))
+    results_all = [
+        {"question": r["question"], "answer": r["answer"], "evaluation": r["evaluation"]}
+        for r in records
+    ]
+    n_failed = sum(r["failed"] for r in records)
+    if n_failed:
+        print(f"{n_failed} 題失敗，重新執行相同指令即可只重跑失敗的題目")
     
     # 儲存成 CSV
     result_df = pd.DataFrame(results_all)
     result_df.to_csv(output_path, index=False)
     print("結果已儲存")
+    if not n_failed and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    if params.openrouter_api_key is None:
+        print(pd.DataFrame(llm_client.get_key_pool().stats()).to_string(index=False))
 
 def evaluate_retrieval_query(query: str, params: object):
     # 建立 retriever
-    retriever = get_retriever(params.faiss_idx_path, params.emb_model, params.k)
+    retriever = get_retriever(
+        params.faiss_idx_path, params.emb_model, params.k, params.emb_cache_path,
+        params.sparse_idx_path, params.dense_weight,
+        nprobe=params.nprobe, ef_search=params.ef_search, use_mmap=params.mmap_index,
+        rerank_model=params.rerank_model, rerank_fetch_k=params.rerank_fetch_k,
+        rerank_budget_ms=params.rerank_budget_ms,
+    )
     k = params.k
 
     docs = retriever.get_relevant_documents(query)[:k]
@@ -247,6 +558,11 @@ if __name__ == "__main__":
     args = create_parser().parse_args()
 
     params = get_params(args.setting)
+    if args.openrouter_setting is not None:
+        params.openrouter_api_key = get_api_key(args.openrouter_setting)
+    params.emb_cache_path = args.emb_cache_path or None
+    if args.faiss_idx_path:
+        params.faiss_idx_path = args.faiss_idx_path
     
     if args.eval_type == "retrieval":
         # 評估檢索
@@ -255,8 +571,22 @@ if __name__ == "__main__":
     elif args.eval_type == "generation":
         # 評估生成
         print("=== 評估生成結果 ===")
-        evaluate_generation(args.benchmark_dir, args.output_path, params)
+        evaluate_generation(args.benchmark_dir, args.output_path, params, args.concurrency, args.rate)
     elif args.eval_type == "retrieval_perquestion":
         evaluate_retrieval_query(args.query, params)
+    elif args.eval_type == "retrieval_batch":
+        # 一次評估多個設定 (Recall@k / MRR / nDCG)
+        settings = [s for s in (args.settings or args.setting).split(",") if s]
+        ks = sorted(int(k) for k in args.ks.split(",") if k)
+        evaluate_retrieval_batch(
+            args.benchmark_dir, args.output_path, settings, ks,
+            params.emb_cache_path, args.faiss_idx_path,
+        )
+    elif args.eval_type == "index_tradeoff":
+        # 近似 index 與 flat index 的 recall / latency 比較
+        if not args.baseline_idx_path:
+            raise ValueError("--baseline_idx_path is required for index_tradeoff")
+        sweep = [int(v) for v in args.sweep.split(",") if v]
+        evaluate_index_tradeoff(args.benchmark_dir, args.output_path, params, args.baseline_idx_path, sweep)
     else:
         raise ValueError(f"Unsupported evaluation type: {args.eval}")
\ No newline at end of file
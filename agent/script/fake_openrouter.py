@@ -0,0 +1,153 @@
+"""
+Fake OpenAI-compatible server for local testing of evaluate.py (generation)
+and the serving LLM client, without spending OpenRouter credits:
+
+    python fake_openrouter.py --port 8001 --rate 2 &
+    OPENROUTER_BASE_URL=http://127.0.0.1:8001/v1 python evaluate.py --eval_type generation ...
+"""
+import json
+import time
+import argparse
+import threading
+from typing import Dict, List
+
+
+def run_fake_server(port: int, rate: float, delay: float, rate_limited_models: List[str] = ()) -> None:
+    """
+    Minimal OpenAI-compatible /chat/completions server (HTTP/1.1 keep-alive,
+    optional SSE streaming) that answers 429 with Retry-After above `rate`
+    requests per second per API key, and always for `rate_limited_models`.
+    Responses carry OpenRouter-style X-RateLimit-Limit / -Remaining / -Reset headers.
+
+    GET /stats returns the number of TCP connections and requests served (per model and key).
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    lock = threading.Lock()
+    recent: Dict[str, List[float]] = {}  # {api key: 最近 1 秒內的請求時間}
+    stats = {"connections": 0, "requests": 0, "rate_limited": 0, "models": {}, "keys": {}}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def setup(self):
+            super().setup()
+            with lock:
+                stats["connections"] += 1
+
+        def _send(self, status: int, body: dict, headers: dict = None) -> None:
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_chunk(self, data: bytes) -> None:
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def _stream(self, model: str, content: str, include_usage: bool, headers: dict = None) -> None:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            pieces = [content[i:i + 4] for i in range(0, len(content), 4)]
+            for piece in pieces:
+                chunk = {
+                    "id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": None}],
+                }
+                self._send_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                time.sleep(delay / max(len(pieces), 1))
+            last = {
+                "id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            }
+            self._send_chunk(f"data: {json.dumps(last)}\n\n".encode("utf-8"))
+            if include_usage:
+                usage = {
+                    "id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [], "usage": {"prompt_tokens": 10, "completion_tokens": len(pieces), "total_tokens": 10 + len(pieces)},
+                }
+                self._send_chunk(f"data: {json.dumps(usage)}\n\n".encode("utf-8"))
+            self._send_chunk(b"data: [DONE]\n\n")
+            self._send_chunk(b"")
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/stats"):
+                with lock:
+                    self._send(200, dict(stats))
+            else:
+                self._send(404, {"error": {"message": "Not found"}})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            model = body.get("model", "fake")
+            api_key = self.headers.get("Authorization", "").removeprefix("Bearer ")[-4:]
+            now = time.time()
+            with lock:
+                stats["requests"] += 1
+                stats["models"][model] = stats["models"].get(model, 0) + 1
+                stats["keys"][api_key] = stats["keys"].get(api_key, 0) + 1
+                window = recent.setdefault(api_key, [])
+                window[:] = [t for t in window if now - t < 1.0]
+                limited = model in rate_limited_models or len(window) >= rate
+                if limited:
+                    stats["rate_limited"] += 1
+                else:
+                    window.append(now)
+                reset = (window[0] if window else now) + 1.0
+                headers = {
+                    "X-RateLimit-Limit": str(int(rate)),
+                    "X-RateLimit-Remaining": str(max(int(rate) - len(window), 0)),
+                    "X-RateLimit-Reset": str(int(reset * 1000)),
+                }
+            if limited:
+                headers["Retry-After"] = "1"
+                self._send(429, {"error": {"message": "Rate limit exceeded", "code": 429}}, headers)
+                return
+
+            prompt = body["messages"][-1]["content"]
+            content = "正確" if "請只回答" in prompt else f"(fake:{model}) {prompt[-30:]}"
+            if body.get("stream"):
+                self._stream(model, content, (body.get("stream_options") or {}).get("include_usage", False), headers)
+                return
+
+            time.sleep(delay)
+            self._send(200, {
+                "id": "fake",
+                "object": "chat.completion",
+                "created": int(now),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11},
+            }, headers)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    print(f"Fake OpenAI-compatible server on http://127.0.0.1:{port}/v1 ({rate} req/s)")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake OpenAI-compatible server with rate limiting")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--rate", type=float, default=2.0, help="Requests per second per API key before answering 429")
+    parser.add_argument("--delay", type=float, default=0.5, help="Simulated generation latency (seconds)")
+    parser.add_argument(
+        "--rate_limited_models", type=str, default="",
+        help="Comma-separated models that always answer 429 (to test model failover)",
+    )
+    args = parser.parse_args()
+    run_fake_server(args.port, args.rate, args.delay, [m for m in args.rate_limited_models.split(",") if m])
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 
 @dataclass
 class ChatbotParams:
@@ -9,8 +9,56 @@ class ChatbotParams:
     judge_model: str
     with_rag: bool = True
     with_style: bool = True
-    openrouter_api_key_id: int = 0
+    # None: 輪流使用環境變數中所有的 OpenRouter key (key pool)；0 / 1 只用 OPENROUTER_API_KEY / OPENROUTER_API_KEY2
+    openrouter_api_key_id: int = None
     openrouter_api_key: str = None
+    # OpenAI client 內建的重試次數 (generation evaluator 設為 0，自行處理 429)
+    llm_max_retries: int = 2
+    # chatbot_model 被限流 (429) 或 5xx 時依序改用的模型；切換前只重試 llm_failover_retries 次
+    llm_fallback_models: list = None
+    llm_failover_retries: int = 0
+    # 等待 LLM 回應的秒數上限，None 表示用 LLM_READ_TIMEOUT (預設 60)
+    llm_timeout: float = None
+    # query embedding 快取 (SQLite)，None 表示只用記憶體 LRU
+    emb_cache_path: str = None
+    # hybrid retrieval: BM25 index (build_sparse_vec.py)，None 表示只用 dense
+    sparse_idx_path: str = None
+    dense_weight: float = 0.5
+    # 近似 index 的查詢參數 (build_faiss_idx.py --index_type)，None 表示用 faiss 預設值
+    nprobe: int = None
+    ef_search: int = None
+    # 以唯讀 mmap 載入 index、文件按需讀取：多個 worker 共用同一份記憶體
+    mmap_index: bool = False
+    # cross-encoder rerank (如 BAAI/bge-reranker-base)，None 表示不 rerank
+    # 先取 rerank_fetch_k 筆候選；超過 rerank_budget_ms 則沿用原本的檢索順序
+    rerank_model: str = None
+    rerank_fetch_k: int = 20
+    rerank_budget_ms: float = 300
+    # 檢索內容的 token 上限 (依 chatbot_model 的 tokenizer 計算)，None 表示不截斷
+    context_max_tokens: int = None
+    # semantic answer cache (只用於 RAG chain)
+    answer_cache: bool = False
+    cache_threshold: float = 0.95
+    cache_ttl: int = 86400
+    cache_size: int = 1000
+    cache_dir: str = "../cache/answer_cache"
+    # 多輪對話 (只用於 RAG chain，Telegram 依 chat id 分開記錄)：歷史截斷到 history_max_tokens
+    # 記憶體最多保留 session_max 個 session，閒置超過 session_ttl 秒重新開始；session_db_path 為 None 表示不寫入 SQLite
+    multiturn: bool = False
+    history_max_tokens: int = 1000
+    session_max: int = 1000
+    session_ttl: int = 86400
+    session_db_path: str = "../cache/sessions.sqlite"
+
+    @classmethod
+    def from_dict(cls, cfg: dict, **kwargs) -> "ChatbotParams":
+        """
+        Build params from a params.json dict, ignoring unknown keys.
+        """
+        names = {f.name for f in fields(cls)}
+        values = {key: value for key, value in cfg.items() if key in names}
+        values.update(kwargs)
+        return cls(**values)
 
 PARAMS_EMB_TENCENT_CONAN = ChatbotParams(
     emb_model="TencentBAC/Conan-embedding-v1",
@@ -28,6 +76,24 @@ PARAMS_EMB_BAAI_BGE_M3 = ChatbotParams(
     judge_model="google/gemma-3-27b-it:free",
 )
 
+PARAMS_EMB_BAAI_BGE_M3_HYBRID = ChatbotParams(
+    emb_model="BAAI/bge-m3",
+    faiss_idx_path="../index/baai_bge_m3_faiss",
+    k=5,
+    chatbot_model="moonshotai/kimi-k2:free",
+    judge_model="google/gemma-3-27b-it:free",
+    sparse_idx_path="../index/bm25_512",
+)
+
+PARAMS_EMB_BAAI_BGE_M3_RERANK = ChatbotParams(
+    emb_model="BAAI/bge-m3",
+    faiss_idx_path="../index/baai_bge_m3_faiss",
+    k=5,
+    chatbot_model="moonshotai/kimi-k2:free",
+    judge_model="google/gemma-3-27b-it:free",
+    rerank_model="BAAI/bge-reranker-base",
+)
+
 PARAMS_EMB_BAAI = ChatbotParams(
     emb_model="BAAI/bge-large-zh-v1.5",
     faiss_idx_path="../index/baai_faiss",
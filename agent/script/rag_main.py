@@ -1,6 +1,7 @@
 import os
 import sys
 import argparse
+import dataclasses
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -22,8 +23,9 @@ def create_parser():
                    default="請問役男的出入境須知",
                    help="User question")
     p.add_argument("--openrouter_setting", type=int,
-                   default=0,
-                   help="OpenRouter API key")
+                   default=None,
+                   choices=[0, 1],
+                   help="OpenRouter API key (default: balance over all configured keys)")
     p.add_argument("--setting", type=str,
                    default="alibaba",
                    choices=["alibaba", "sentencetf", "alibaba_worag"],
@@ -31,6 +33,19 @@ def create_parser():
     return p
 
 
+def get_api_key(key_id: int = None):
+    """
+    OpenRouter API key for `key_id`; None means the key pool (all configured keys).
+    """
+    if key_id is None:
+        return None
+    if key_id == 0:
+        return os.getenv("OPENROUTER_API_KEY")
+    if key_id == 1:
+        return os.getenv("OPENROUTER_API_KEY2")
+    raise ValueError(f"Unsupported OpenRouter setting: {key_id}")
+
+
 def get_params(setting: str):
     """
     根據設定名稱返回對應的參數。
@@ -58,6 +73,10 @@ def get_params(setting: str):
         params = PARAMS.PARAMS_EMB_BAAI
     elif setting == "baai_bge_m3":
         params = PARAMS.PARAMS_EMB_BAAI_BGE_M3
+    elif setting == "baai_bge_m3_hybrid":
+        params = PARAMS.PARAMS_EMB_BAAI_BGE_M3_HYBRID
+    elif setting == "baai_bge_m3_rerank":
+        params = PARAMS.PARAMS_EMB_BAAI_BGE_M3_RERANK
     elif setting == "tencent_conan":
         params = PARAMS.PARAMS_EMB_TENCENT_CONAN
     elif setting == "custom":
@@ -75,13 +94,8 @@ def get_params(setting: str):
     else:
         raise ValueError(f"Unsupported setting: {setting}")
 
-    # 設定 OpenRouter API key
-    if params.openrouter_api_key_id == 0:
-        params.openrouter_api_key = os.getenv("OPENROUTER_API_KEY")
-    elif params.openrouter_api_key_id == 1:
-        params.openrouter_api_key = os.getenv("OPENROUTER_API_KEY2")
-    else:
-        raise ValueError(f"Unsupported OpenRouter setting: {params.openrouter_setting}")
+    # 回傳副本並設定 OpenRouter API key：呼叫端修改參數時不會影響模組層級的 preset
+    params = dataclasses.replace(params, openrouter_api_key=get_api_key(params.openrouter_api_key_id))
 
     return params
 
@@ -89,6 +103,8 @@ def get_params(setting: str):
 def test():
     args = create_parser().parse_args()
     params = get_params(args.setting)
+    if args.openrouter_setting is not None:
+        params.openrouter_api_key = get_api_key(args.openrouter_setting)
     print("Questions:", args.query)
 
     # ===== A) Chat WITHOUT RAG =====
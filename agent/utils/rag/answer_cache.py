@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import atexit
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterator, Optional, Union
+
+import numpy as np
+
+from . import tracing
+
+class SemanticAnswerCache:
+    """
+    Answer cache keyed by query similarity.
+
+    A cached answer is reused when a new query's embedding is within `threshold`
+    cosine similarity of a cached query in the same namespace (chain config,
+    index version ...). Entries expire after `ttl` seconds and the
+    least recently used ones are evicted beyond `max_entries`.
+
+    Persisted as `entries.json` + `vectors.npy` under `cache_dir`.
+    """
+
+    def __init__(
+        self,
+        embeddings: object,
+        threshold: float = 0.95,
+        ttl: int = 86400,
+        max_entries: int = 1000,
+        cache_dir: str = None,
+        save_interval: float = 30.0,
+    ):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.save_interval = save_interval
+
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._entries = OrderedDict()  # {entry_id: {"namespace", "query", "answer", "created_at", "vector"}}
+        self._next_id = 0
+        self._dirty = False
+        self._last_save = time.time()
+        self.hits = 0
+        self.misses = 0
+
+        if cache_dir is not None:
+            self.load()
+            atexit.register(self.save)
+
+    def embed(self, query: str) -> np.ndarray:
+        vec = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        return vec / (np.linalg.norm(vec) + 1e-12)
+
+    def _expire(self, now: float) -> None:
+        expired = [i for i, e in self._entries.items() if now - e["created_at"] > self.ttl]
+        for i in expired:
+            del self._entries[i]
+        if expired:
+            self._dirty = True
+
+    def lookup(self, query: str, namespace: str, vector: np.ndarray = None) -> Optional[str]:
+        """
+        Return the cached answer of the most similar query, or None on a miss.
+        """
+        if vector is None:
+            vector = self.embed(query)
+
+        with self._lock:
+            self._expire(time.time())
+            candidates = [(i, e) for i, e in self._entries.items() if e["namespace"] == namespace]
+            if candidates:
+                matrix = np.stack([e["vector"] for _, e in candidates])
+                scores = matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    entry_id, entry = candidates[best]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return entry["answer"]
+            self.misses += 1
+        return None
+
+    def store(self, query: str, namespace: str, answer: str, vector: np.ndarray = None) -> None:
+        if not answer:
+            return
+        if vector is None:
+            vector = self.embed(query)
+
+        with self._lock:
+            self._entries[self._next_id] = {
+                "namespace": namespace,
+                "query": query,
+                "answer": answer,
+                "created_at": time.time(),
+                "vector": vector,
+            }
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+        if self.cache_dir is not None and time.time() - self._last_save >= self.save_interval:
+            self.save()
+
+    def load(self) -> None:
+        meta_path = os.path.join(self.cache_dir, "entries.json")
+        vec_path = os.path.join(self.cache_dir, "vectors.npy")
+        if not (os.path.exists(meta_path) and os.path.exists(vec_path)):
+            return
+
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        vectors = np.load(vec_path)
+        if len(meta) != len(vectors):
+            print(f"[AnswerCache] Corrupted cache under {self.cache_dir}, ignored")
+            return
+
+        with self._lock:
+            for entry, vector in zip(meta, vectors):
+                entry["vector"] = vector
+                self._entries[self._next_id] = entry
+                self._next_id += 1
+            self._expire(time.time())
+        print(f"[AnswerCache] Loaded {len(self._entries)} entries from {self.cache_dir}")
+
+    def save(self) -> None:
+        """
+        Write the cache atomically (temp files + os.replace).
+        """
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                entries = list(self._entries.values())
+                self._dirty = False
+                self._last_save = time.time()
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            meta = [{k: v for k, v in e.items() if k != "vector"} for e in entries]
+            if entries:
+                vectors = np.stack([e["vector"] for e in entries])
+            else:
+                vectors = np.zeros((0, 0), dtype=np.float32)
+
+            meta_path = os.path.join(self.cache_dir, "entries.json")
+            vec_path = os.path.join(self.cache_dir, "vectors.npy")
+            with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            with open(vec_path + ".tmp", "wb") as f:
+                np.save(f, vectors)
+            os.replace(vec_path + ".tmp", vec_path)
+            os.replace(meta_path + ".tmp", meta_path)
+
+
+class CachedChain:
+    """
+    Wrap a RAG chain so that near-duplicate questions skip retrieval and generation.
+    """
+
+    def __init__(self, chain: object, cache: SemanticAnswerCache, namespace: Union[str, Callable[[], str]]):
+        self.chain = chain
+        self.cache = cache
+        self.namespace = namespace
+
+    def get_namespace(self) -> str:
+        return self.namespace() if callable(self.namespace) else self.namespace
+
+    def invoke(self, query: str, config: dict = None) -> str:
+        namespace = self.get_namespace()
+        vector = self.cache.embed(query)
+        with tracing.span("answer_cache_lookup"):
+            answer = self.cache.lookup(query, namespace, vector)
+        if answer is not None:
+            return answer
+        answer = self.chain.invoke(query, config=config)
+        self.cache.store(query, namespace, answer, vector)
+        return answer
+
+    def stream(self, query: str, config: dict = None) -> Iterator[str]:
+        namespace = self.get_namespace()
+        vector = self.cache.embed(query)
+        with tracing.span("answer_cache_lookup"):
+            answer = self.cache.lookup(query, namespace, vector)
+        if answer is not None:
+            yield answer
+            return
+        pieces = []
+        for piece in self.chain.stream(query, config=config):
+            pieces.append(piece)
+            yield piece
+        self.cache.store(query, namespace, "".join(pieces), vector)
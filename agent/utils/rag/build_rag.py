@@ -1,20 +1,38 @@
+from operator import itemgetter
+
 from langchain_community.vectorstores import FAISS
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import Runnable, RunnablePassthrough
+from langchain_core.runnables import Runnable, RunnableBranch, RunnablePassthrough
+from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStoreRetriever
 from langchain import hub
 from IPython.display import display, Image
 
-from . import create_emb
+from . import context_pack, create_emb, llm_client, process_faiss_idx, rerank, sparse_idx, tracing
 
 def format_docs(docs: list[Document]) -> str:
-    return "\n\n".join(d.page_content for d in docs)
+    # 同一份文件的 chunk 合併、重複的 chunk 只保留一次
+    return "\n\n".join(context_pack.pack_context(docs))
+
+def get_format_docs(params: object):
+    """
+    `format_docs` that also truncates the context to `params.context_max_tokens`
+    tokens of `params.chatbot_model`.
+    """
+    if params.context_max_tokens is None:
+        return format_docs
+    count_tokens = context_pack.get_token_counter(params.chatbot_model)
+
+    def format_docs_with_budget(docs: list[Document]) -> str:
+        return "\n\n".join(context_pack.pack_context(docs, params.context_max_tokens, count_tokens))
+    return format_docs_with_budget
 
 def chat_without_rag(params: object) -> object:
-    llm = call_llm(params.chatbot_model, params.openrouter_api_key)
+    llm = call_llm_with_params(params)
     prompt_wo = ChatPromptTemplate.from_messages([
         ("system", 
         "你是一個有幫助且簡潔的助理。"
@@ -34,8 +52,15 @@ def chat_without_rag(params: object) -> object:
     chain_wo = prompt_wo | llm | StrOutputParser()
     return chain_wo
 
-def chat_with_rag(params: object) -> object:
-    retriever = get_retriever(params.faiss_idx_path, params.emb_model, params.k)
+def chat_with_rag(params: object, retriever: object = None) -> object:
+    if retriever is None:
+        retriever = get_retriever(
+            params.faiss_idx_path, params.emb_model, params.k, params.emb_cache_path,
+            params.sparse_idx_path, params.dense_weight,
+            nprobe=params.nprobe, ef_search=params.ef_search, use_mmap=params.mmap_index,
+            rerank_model=params.rerank_model, rerank_fetch_k=params.rerank_fetch_k,
+            rerank_budget_ms=params.rerank_budget_ms,
+        )
     prompt_rag = ChatPromptTemplate.from_messages([
         ("system", 
         "你是一個有幫助且簡潔的助理。"
@@ -51,11 +76,11 @@ def chat_with_rag(params: object) -> object:
         "4. 不要使用任何 Markdown 標記（例如 ** 或 ##），只輸出純文字。"
         )
     ])
-    llm = call_llm(params.chatbot_model, params.openrouter_api_key)
+    llm = call_llm_with_params(params)
     # RAG chain: map the user query to retriever -> format -> prompt -> llm
     chain_rag = (
         {
-            "context": retriever | format_docs,
+            "context": retriever | get_format_docs(params),
             "question": RunnablePassthrough()
         }
         | prompt_rag
@@ -65,8 +90,15 @@ def chat_with_rag(params: object) -> object:
 
     return chain_rag
 
-def chat_with_rag_style(params: object) -> object:
-    retriever = get_retriever(params.faiss_idx_path, params.emb_model, params.k)
+def chat_with_rag_style(params: object, retriever: object = None) -> object:
+    if retriever is None:
+        retriever = get_retriever(
+            params.faiss_idx_path, params.emb_model, params.k, params.emb_cache_path,
+            params.sparse_idx_path, params.dense_weight,
+            nprobe=params.nprobe, ef_search=params.ef_search, use_mmap=params.mmap_index,
+            rerank_model=params.rerank_model, rerank_fetch_k=params.rerank_fetch_k,
+            rerank_budget_ms=params.rerank_budget_ms,
+        )
     
     prompt_rag = ChatPromptTemplate.from_messages([
         ("system", 
@@ -95,11 +127,11 @@ def chat_with_rag_style(params: object) -> object:
         "</few_shot_examples>\n\n"
         )
     ])
-    llm = call_llm(params.chatbot_model, params.openrouter_api_key)
+    llm = call_llm_with_params(params)
     # RAG chain: map the user query to retriever -> format -> prompt -> llm
     chain_rag = (
         {
-            "context": retriever | format_docs,
+            "context": retriever | get_format_docs(params),
             "question": RunnablePassthrough()
         }
         | prompt_rag
@@ -109,84 +141,155 @@ def chat_with_rag_style(params: object) -> object:
 
     return chain_rag
 
-def call_llm(chatbot_model: object, api_key: str):
-    
-    llm = ChatOpenAI(
-        model=chatbot_model,
-        base_url="https://openrouter.ai/api/v1",
-        api_key=api_key,
+def call_llm(
+    chatbot_model: str,
+    api_key: str,
+    max_retries: int = 2,
+    fallback_models: list = None,
+    failover_retries: int = 0,
+    read_timeout: float = None,
+):
+    # 共用連線池；chatbot_model 被限流 (429) 或 5xx 時依序改用 fallback_models
+    return llm_client.get_llm(
+        [chatbot_model, *(fallback_models or [])],
+        api_key,
         temperature=0.1,
+        max_retries=max_retries,
+        failover_retries=failover_retries,
+        read_timeout=read_timeout,
+    )
+
+def call_llm_with_params(params: object):
+    return call_llm(
+        params.chatbot_model,
+        params.openrouter_api_key,
+        params.llm_max_retries,
+        params.llm_fallback_models,
+        params.llm_failover_retries,
+        params.llm_timeout,
     )
 
-    return llm
+def load_vectorstore(
+    faiss_idx_path: str,
+    embeddings: object,
+    nprobe: int = None,
+    ef_search: int = None,
+    use_mmap: bool = False,
+) -> FAISS:
+    # index.json 記錄 index 類型 / metric；nprobe (IVF)、ef_search (HNSW) 為查詢時參數
+    with tracing.span("index_load"):
+        return process_faiss_idx.load_index(
+            faiss_idx_path, embeddings, nprobe=nprobe, ef_search=ef_search, use_mmap=use_mmap
+        )
 
-def get_retriever(faiss_idx_path, emb_model, k):
+def get_retriever(
+    faiss_idx_path, emb_model, k, emb_cache_path=None, sparse_idx_path=None, dense_weight=0.5,
+    nprobe=None, ef_search=None, use_mmap=False,
+    rerank_model=None, rerank_fetch_k=20, rerank_budget_ms=300,
+):
     # Get embedding model
-    embeddings = create_emb.get_embedding_model(emb_model)
+    embeddings = create_emb.get_embedding_model(emb_model, cache_path=emb_cache_path)
+
+    # Rerank: 先取較多候選，再由 cross-encoder 選出前 k 筆
+    fetch_k = max(rerank_fetch_k, k) if rerank_model else k
 
     # Load FAISS index and create retriever
-    vectorstore = FAISS.load_local(
-        faiss_idx_path,
-        embeddings,
-        allow_dangerous_deserialization=True,  # required for many FAISS saves
-    )
-    retriever = vectorstore.as_retriever(search_kwargs={"k": k})
+    vectorstore = load_vectorstore(faiss_idx_path, embeddings, nprobe=nprobe, ef_search=ef_search, use_mmap=use_mmap)
+    retriever = vectorstore.as_retriever(search_kwargs={"k": fetch_k})
+
+    # Hybrid: BM25 + dense, fused by reciprocal rank
+    if sparse_idx_path:
+        retriever = get_hybrid_retriever(retriever, sparse_idx_path, fetch_k, dense_weight)
+    if rerank_model:
+        retriever = get_rerank_retriever(retriever, rerank.CrossEncoderReranker(rerank_model), k, rerank_budget_ms)
     return retriever
 
-def build_multiturn_rag_chain(emb_model: str, faiss_idx_path: str, k: int, chatbot_model: str):
-    retriever = get_retriever(faiss_idx_path, embeddings, k)
-    llm = call_llm(chatbot_model)
-    
+def get_retriever_embeddings(retriever):
+    """
+    Embedding model of the dense retriever inside a (hybrid / rerank) retriever.
+    """
+    # rerank 包在 .base、hybrid 包在 .dense，一路拆到 FAISS 的 VectorStoreRetriever
+    while not isinstance(retriever, VectorStoreRetriever):
+        retriever = getattr(retriever, "base", None) or getattr(retriever, "dense")
+    return retriever.vectorstore.embeddings
+
+def get_hybrid_retriever(dense_retriever, sparse_idx_path, k, dense_weight=0.5):
+    sparse_retriever = sparse_idx.load_sparse_retriever(sparse_idx_path, k)
+    return sparse_idx.HybridRetriever(
+        dense=dense_retriever,
+        sparse=sparse_retriever,
+        k=k,
+        dense_weight=dense_weight,
+    )
+
+def get_rerank_retriever(base_retriever, reranker, k, budget_ms=300):
+    return rerank.RerankRetriever(base=base_retriever, reranker=reranker, k=k, budget_ms=budget_ms)
+
+def build_multiturn_rag_chain(params: object, session_store: object, retriever: object = None) -> object:
+    """
+    RAG chain with per-session chat history.
+
+    Invoke with {"question": str} and config {"configurable": {"session_id": str}};
+    histories come from `session_store` (chat_history.SessionStore).
+    """
+    if retriever is None:
+        retriever = get_retriever(
+            params.faiss_idx_path, params.emb_model, params.k, params.emb_cache_path,
+            params.sparse_idx_path, params.dense_weight,
+            nprobe=params.nprobe, ef_search=params.ef_search, use_mmap=params.mmap_index,
+            rerank_model=params.rerank_model, rerank_fetch_k=params.rerank_fetch_k,
+            rerank_budget_ms=params.rerank_budget_ms,
+        )
+    llm = call_llm_with_params(params)
+
     # 1) 問題改寫（含歷史）：(chat_history, question) -> standalone query
     prompt_w_hist = ChatPromptTemplate.from_messages([
         ("system",
-        "You reformulate the user's latest question into a standalone search query, "
-        "grounded by the chat history. Do NOT answer."),
+        "請根據對話紀錄，將使用者最新的問題改寫成不需要對話紀錄也能理解的獨立查詢。"
+        "只輸出改寫後的查詢，不要回答問題。"),
         MessagesPlaceholder("chat_history"),
         ("human", "{question}")
     ])
+    question_condenser = (prompt_w_hist | llm | StrOutputParser()).with_config(run_name="question_condenser")
 
-    question_condenser = prompt_w_hist | llm | StrOutputParser()
+    # 沒有歷史時問題本身就是獨立查詢，省下一次 LLM 呼叫
+    standalone_question = RunnableBranch(
+        (lambda inputs: not inputs["chat_history"], itemgetter("question")),
+        question_condenser,
+    )
 
     # 2) 用改寫後的查詢去檢索
-    def retrieve_with_history(inputs):
-        # inputs 會帶有 {"question": str, "chat_history": [...]}
-        standalone = question_condenser.invoke(inputs)
-        docs = retriever.invoke(standalone)
-        return format_docs(docs)
+    retrieve_with_history = standalone_question | retriever | get_format_docs(params)
 
     # 3) RAG 主鏈：取 context + question → 回答（含歷史）
-    ANSWER_PROMPT = ChatPromptTemplate.from_messages([
+    answer_prompt = ChatPromptTemplate.from_messages([
         ("system",
-        "You are a helpful, concise assistant. Use the provided context to answer. "
-        "If the answer isn't contained in the context, say you're unsure."),
+        "你是一個有幫助且簡潔的助理。"
+        ),
         MessagesPlaceholder("chat_history"),
-        ("human", "Context:\n{context}\n\nQuestion: {question}\n\nAnswer:")
+        ("human",
+        "檢索內容：\n{context}\n\n"
+        "問題：{question}\n\n"
+        "⚠️ 請務必遵循以下規則：\n"
+        "1. 根據提供的檢索內容與對話紀錄回答問題。\n"
+        "2. 如果檢索內容中沒有答案，請回答『根據提供的內容無法回答』。\n"
+        "3. 請用中文作答，不得使用其他語言。\n"
+        "4. 不要使用任何 Markdown 標記（例如 ** 或 ##），只輸出純文字。"
+        )
     ])
 
     rag_core = (
-        RunnableMap({
-            "context": retrieve_with_history,
-            "question": RunnablePassthrough(),
-        })
-        | ANSWER_PROMPT
+        RunnablePassthrough.assign(context=retrieve_with_history)
+        | answer_prompt
         | llm
         | StrOutputParser()
     )
 
-    # 4) 多輪歷史封裝（用 session_id 管理）
-    store = {}  # {session_id: ChatMessageHistory}
-
-    def get_session_history(session_id: str):
-        if session_id not in store:
-            store[session_id] = ChatMessageHistory()
-        return store[session_id]
-
+    # 4) 多輪歷史封裝（用 session_id 管理；歷史依 token 上限截斷，閒置的 session 會被淘汰）
     rag_with_history = RunnableWithMessageHistory(
         rag_core,
-        get_session_history,
+        session_store.get,
         input_messages_key="question",
         history_messages_key="chat_history",
-        output_messages_key="output"
     )
     return rag_with_history
@@ -0,0 +1,222 @@
+import os
+import time
+import hashlib
+import threading
+from functools import partial
+
+from . import context_pack, create_emb, tracing
+from .answer_cache import CachedChain, SemanticAnswerCache
+from .build_rag import (
+    build_multiturn_rag_chain, chat_with_rag, chat_with_rag_style, chat_without_rag,
+    get_rerank_retriever, load_vectorstore,
+)
+from .chat_history import SessionStore
+from .index_reload import IndexWatcher, LiveIndex, LiveRetriever, LiveSparseRetriever
+from .sparse_idx import HybridRetriever, get_sparse_index_version, load_sparse_retriever
+from .rerank import CrossEncoderReranker
+
+
+def session_key(params: object) -> tuple:
+    """
+    Settings of a multi-turn session store.
+    """
+    return (params.session_db_path, params.history_max_tokens, params.session_ttl, params.session_max)
+
+
+def chain_key(params: object) -> tuple:
+    """
+    Effective config of a chain: two params with the same key build identical chains.
+    """
+    llm = (
+        params.chatbot_model,
+        tuple(params.llm_fallback_models or ()),
+        params.llm_failover_retries,
+        params.llm_timeout,
+    )
+    if not params.with_rag:
+        return ("worag", *llm, params.openrouter_api_key)
+    if params.multiturn:
+        kind = "rag_multiturn"
+    else:
+        kind = "rag_style" if params.with_style else "rag"
+    return (
+        kind,
+        params.emb_model,
+        params.faiss_idx_path,
+        params.k,
+        *llm,
+        params.openrouter_api_key,
+        params.answer_cache,
+        params.sparse_idx_path,
+        params.dense_weight,
+        params.nprobe,
+        params.ef_search,
+        params.mmap_index,
+        params.rerank_model,
+        params.rerank_fetch_k,
+        params.rerank_budget_ms,
+        params.context_max_tokens,
+        session_key(params) if params.multiturn else None,
+    )
+
+
+class ChainRegistry:
+    """
+    Process-resident cache of built chains.
+
+    Embedding models, FAISS indexes and chains are built once and reused across
+    messages, so only the first request of a config pays the load cost.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # get_chain 持有 self._lock 時會取得 session store，因此另用一個 lock
+        self._session_lock = threading.Lock()
+        self._embeddings = {}    # {emb_model: Embeddings}
+        self._live_indexes = {}  # {(faiss_idx_path, emb_model, nprobe, ef_search, use_mmap): LiveIndex}
+        self._live_sparse = {}   # {(sparse_idx_path, k): LiveIndex of a BM25 retriever}
+        self._chains = {}        # {chain_key: Runnable}
+        self._answer_caches = {} # {emb_model: SemanticAnswerCache}
+        self._rerankers = {}     # {rerank_model: CrossEncoderReranker}
+        self._session_stores = {} # {session_key: SessionStore}
+        self._watcher = None
+
+    def get_embeddings(self, emb_model: str, cache_path: str = None) -> object:
+        # retriever 與 answer cache 共用同一個 (有 query 快取的) embedding model
+        if emb_model not in self._embeddings:
+            self._embeddings[emb_model] = create_emb.get_embedding_model(emb_model, cache_path=cache_path)
+        return self._embeddings[emb_model]
+
+    def get_live_index(
+        self,
+        faiss_idx_path: str,
+        emb_model: str,
+        emb_cache_path: str = None,
+        nprobe: int = None,
+        ef_search: int = None,
+        use_mmap: bool = False,
+    ) -> LiveIndex:
+        key = (faiss_idx_path, emb_model, nprobe, ef_search, use_mmap)
+        if key not in self._live_indexes:
+            embeddings = self.get_embeddings(emb_model, emb_cache_path)
+            loader = partial(load_vectorstore, nprobe=nprobe, ef_search=ef_search, use_mmap=use_mmap)
+            self._live_indexes[key] = LiveIndex(faiss_idx_path, embeddings, loader)
+        return self._live_indexes[key]
+
+    def get_live_sparse_index(self, sparse_idx_path: str, k: int) -> LiveIndex:
+        key = (sparse_idx_path, k)
+        if key not in self._live_sparse:
+            self._live_sparse[key] = LiveIndex(
+                sparse_idx_path, None,
+                loader=lambda index_dir, _: load_sparse_retriever(index_dir, k),
+                get_version=get_sparse_index_version,
+            )
+        return self._live_sparse[key]
+
+    def get_reranker(self, rerank_model: str) -> CrossEncoderReranker:
+        if rerank_model not in self._rerankers:
+            self._rerankers[rerank_model] = CrossEncoderReranker(rerank_model)
+        return self._rerankers[rerank_model]
+
+    def get_answer_cache(self, params: object) -> SemanticAnswerCache:
+        # 每個 embedding model 一份 cache（向量維度不同）
+        if params.emb_model not in self._answer_caches:
+            self._answer_caches[params.emb_model] = SemanticAnswerCache(
+                self.get_embeddings(params.emb_model, params.emb_cache_path),
+                threshold=params.cache_threshold,
+                ttl=params.cache_ttl,
+                max_entries=params.cache_size,
+                cache_dir=os.path.join(params.cache_dir, params.emb_model.replace("/", "__")),
+            )
+        return self._answer_caches[params.emb_model]
+
+    def get_session_store(self, params: object) -> SessionStore:
+        # 所有 multiturn chain 共用 session，切換模型後對話仍可延續（token 數依第一個模型的 tokenizer 估算）
+        key = session_key(params)
+        with self._session_lock:
+            if key not in self._session_stores:
+                self._session_stores[key] = SessionStore(
+                    max_tokens=params.history_max_tokens,
+                    count_tokens=context_pack.get_token_counter(params.chatbot_model),
+                    max_sessions=params.session_max,
+                    ttl=params.session_ttl,
+                    db_path=params.session_db_path,
+                )
+            return self._session_stores[key]
+
+    def get_chain(self, params: object) -> object:
+        key = chain_key(params)
+        chain = self._chains.get(key)
+        if chain is not None:
+            return chain
+
+        with self._lock:
+            # 其他 thread 可能已經建好
+            if key in self._chains:
+                return self._chains[key]
+
+            start = time.perf_counter()
+            if params.with_rag:
+                live_index = self.get_live_index(
+                    params.faiss_idx_path, params.emb_model, params.emb_cache_path,
+                    params.nprobe, params.ef_search, params.mmap_index,
+                )
+                # rerank 時先取較多候選
+                fetch_k = max(params.rerank_fetch_k, params.k) if params.rerank_model else params.k
+                retriever = LiveRetriever(live_index=live_index, search_kwargs={"k": fetch_k})
+                sparse_index = None
+                if params.sparse_idx_path:
+                    # BM25 index 與 FAISS 一樣在 version.json 改變時熱更新
+                    sparse_index = self.get_live_sparse_index(params.sparse_idx_path, fetch_k)
+                    retriever = HybridRetriever(
+                        dense=retriever,
+                        sparse=LiveSparseRetriever(live_index=sparse_index),
+                        k=fetch_k,
+                        dense_weight=params.dense_weight,
+                    )
+                if params.rerank_model:
+                    retriever = get_rerank_retriever(
+                        retriever, self.get_reranker(params.rerank_model), params.k, params.rerank_budget_ms
+                    )
+                if params.multiturn:
+                    # 回答依賴對話歷史，不使用 answer cache
+                    chain = build_multiturn_rag_chain(params, self.get_session_store(params), retriever=retriever)
+                elif params.with_style:
+                    chain = chat_with_rag_style(params, retriever=retriever)
+                else:
+                    chain = chat_with_rag(params, retriever=retriever)
+
+                if params.answer_cache and not params.multiturn:
+                    # 任何會改變 chain 的設定 (rerank、hybrid、context 長度 ...) 都不共用快取答案；
+                    # 快取會存到磁碟，因此用穩定的 sha1 而非 hash()
+                    digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+                    prefix = f"{params.chatbot_model}|{digest}"
+                    # index 熱更新後 version 改變，舊的快取答案自動失效
+                    def namespace(live_index=live_index, sparse_index=sparse_index, prefix=prefix):
+                        if sparse_index is None:
+                            return f"{prefix}@{live_index.version}"
+                        return f"{prefix}@{live_index.version}+{sparse_index.version}"
+                    chain = CachedChain(chain, self.get_answer_cache(params), namespace)
+            else:
+                chain = chat_without_rag(params)
+
+            self._chains[key] = chain
+            tracing.record("chain_build", time.perf_counter() - start)
+            print(f"[ChainRegistry] Built chain {key[:2]}")
+        return chain
+
+    def warm_up(self, params: object) -> None:
+        """
+        Build the chain of `params` ahead of the first message.
+        """
+        self.get_chain(params)
+
+    def start_index_watcher(self, interval: float = 10.0) -> None:
+        """
+        Reload indexes in the background whenever their version.json changes.
+        """
+        if self._watcher is None:
+            self._watcher = IndexWatcher(
+                lambda: [*self._live_indexes.values(), *self._live_sparse.values()], interval
+            )
+            self._watcher.start()
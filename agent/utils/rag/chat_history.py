@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Sequence
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, HumanMessage, messages_from_dict, messages_to_dict
+
+
+def trim_history(messages: List[BaseMessage], max_tokens: int, count_tokens: Callable[[str], int]) -> List[BaseMessage]:
+    """
+    Keep the most recent messages that fit in `max_tokens`, starting on a user turn.
+    """
+    kept, total = [], 0
+    for message in reversed(messages):
+        total += count_tokens(message.content)
+        if total > max_tokens:
+            break
+        kept.append(message)
+    kept.reverse()
+    # 不要以沒有對應問題的回答開頭
+    while kept and not isinstance(kept[0], HumanMessage):
+        kept.pop(0)
+    return kept
+
+
+class SessionHistory(BaseChatMessageHistory):
+    """
+    Chat history of one session, trimmed to the store's token budget on every write.
+    """
+
+    def __init__(self, store: "SessionStore", session_id: str, messages: List[BaseMessage] = None, last_active: float = None):
+        self.store = store
+        self.session_id = session_id
+        self.messages = messages or []
+        self.last_active = last_active or time.time()
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.messages = trim_history(self.messages + list(messages), self.store.max_tokens, self.store.count_tokens)
+        self.last_active = time.time()
+        self.store.save(self)
+
+    def clear(self) -> None:
+        self.messages = []
+        self.last_active = time.time()
+        self.store.save(self)
+
+
+class SessionStore:
+    """
+    Chat histories keyed by session id (Telegram chat id).
+
+    At most `max_sessions` histories stay in memory (least recently used are
+    evicted); sessions idle for more than `ttl` seconds start over. With
+    `db_path`, every turn is written to SQLite, so evicted sessions and
+    restarts keep their history until the TTL expires.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 1000,
+        count_tokens: Callable[[str], int] = len,
+        max_sessions: int = 1000,
+        ttl: int = 86400,
+        db_path: str = None,
+        purge_interval: float = 600.0,
+    ):
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.db_path = db_path
+        self.purge_interval = purge_interval
+
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # {session_id: SessionHistory}
+        self._last_purge = 0.0
+        self._db = None
+        if db_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS chat_history ("
+                "session_id TEXT PRIMARY KEY, messages TEXT, updated_at REAL)"
+            )
+            self._db.commit()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _load(self, session_id: str, now: float) -> SessionHistory:
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT messages, updated_at FROM chat_history WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is not None and now - row[1] <= self.ttl:
+                return SessionHistory(self, session_id, messages_from_dict(json.loads(row[0])), row[1])
+        return SessionHistory(self, session_id)
+
+    def get(self, session_id: str) -> SessionHistory:
+        now = time.time()
+        with self._lock:
+            history = self._sessions.get(session_id)
+            if history is not None and now - history.last_active > self.ttl:
+                history = None
+            if history is None:
+                history = self._load(session_id, now)
+            self._sessions[session_id] = history
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            return history
+
+    def save(self, history: SessionHistory) -> None:
+        if self._db is None:
+            return
+        with self._lock:
+            if history.messages:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO chat_history VALUES (?, ?, ?)",
+                    (history.session_id, json.dumps(messages_to_dict(history.messages), ensure_ascii=False), history.last_active),
+                )
+            else:
+                self._db.execute("DELETE FROM chat_history WHERE session_id = ?", (history.session_id,))
+            # 定期刪除閒置超過 TTL 的 session
+            if history.last_active - self._last_purge >= self.purge_interval:
+                self._db.execute("DELETE FROM chat_history WHERE updated_at < ?", (history.last_active - self.ttl,))
+                self._last_purge = history.last_active
+            self._db.commit()
+
+    def clear(self, session_id: str) -> None:
+        self.get(session_id).clear()
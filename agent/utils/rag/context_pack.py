@@ -0,0 +1,135 @@
+import re
+from typing import Callable, Dict, List
+
+from langchain_core.documents import Document
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+MIN_OVERLAP = 20    # 相鄰 chunk 至少重疊這麼多字元才合併
+MAX_OVERLAP = 1024  # 搜尋重疊的上限 (>= splitter 的 chunk_overlap)
+MIN_TAIL_TOKENS = 32  # 預算剩下不到這麼多 token 時，不再截斷放入下一段
+
+_CJK = re.compile(r"[\u3400-\u9fff\uf900-\ufaff\u3000-\u303f\uff00-\uffef]")
+
+
+def get_token_counter(chatbot_model: str = None) -> Callable[[str], int]:
+    """
+    Token counter for `chatbot_model`.
+
+    Uses tiktoken when available (the model's own encoding if known, else
+    cl100k_base as an approximation for OpenRouter models); otherwise
+    estimates one token per CJK character and per 4 other characters.
+    """
+    if tiktoken is not None:
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model((chatbot_model or "").split("/")[-1])
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+            return lambda text: len(encoding.encode(text, disallowed_special=()))
+        except Exception as e:
+            # encoding 檔第一次使用時需下載；離線時改用估計值
+            print(f"[ContextPack] tiktoken unavailable ({e.__class__.__name__}), estimating token counts")
+
+    def estimate(text: str) -> int:
+        n_cjk = len(_CJK.findall(text))
+        return n_cjk + (len(text) - n_cjk + 3) // 4
+    return estimate
+
+
+def _chunk_no(doc: Document) -> int:
+    # chunk id 為 "<uuid>:<i>" (process_faiss_idx.split_with_ids)
+    doc_id = getattr(doc, "id", None) or ""
+    _, _, no = doc_id.rpartition(":")
+    return int(no) if no.isdigit() else -1
+
+
+def _overlap(left: str, right: str) -> int:
+    # left 的結尾與 right 的開頭重疊的最長長度
+    for n in range(min(len(left), len(right), MAX_OVERLAP), MIN_OVERLAP - 1, -1):
+        if left.endswith(right[:n]):
+            return n
+    return 0
+
+
+def merge_chunks(texts: List[str]) -> List[str]:
+    """
+    Merge consecutive chunks of one document that overlap (splitter overlap)
+    or contain each other; non-adjacent chunks stay separate.
+    """
+    merged: List[str] = []
+    for text in texts:
+        if merged:
+            last = merged[-1]
+            if text in last:
+                continue
+            if last in text:
+                merged[-1] = text
+                continue
+            n = _overlap(last, text)
+            if n:
+                merged[-1] = last + text[n:]
+                continue
+        merged.append(text)
+    return merged
+
+
+def _truncate(text: str, max_tokens: int, count_tokens: Callable[[str], int]) -> str:
+    # 二分搜尋可放入預算的最長前綴
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
+
+def pack_context(
+    docs: List[Document],
+    max_tokens: int = None,
+    count_tokens: Callable[[str], int] = None,
+) -> List[str]:
+    """
+    Turn retrieved chunks (best first) into context passages.
+
+    Chunks of the same `uuid` are merged (overlapping chunks are stitched
+    together), exact duplicates are dropped, each document keeps the rank of
+    its best chunk, and passages are added until `max_tokens` is reached; the
+    passage crossing the budget is truncated.
+    """
+    groups: Dict[str, List[tuple]] = {}
+    seen = set()
+    for rank, doc in enumerate(docs):
+        key = " ".join(doc.page_content.split())
+        if key in seen:
+            continue
+        seen.add(key)
+        uuid_ = doc.metadata.get("uuid") or f"#{rank}"
+        groups.setdefault(uuid_, []).append((_chunk_no(doc), rank, doc.page_content))
+
+    passages = []
+    for chunks in groups.values():  # dict 保留插入順序 = 最佳 chunk 的排名
+        chunks.sort(key=lambda c: (c[0], c[1]))
+        passages.append("\n".join(merge_chunks([text for _, _, text in chunks])))
+
+    if max_tokens is None:
+        return passages
+
+    count_tokens = count_tokens or get_token_counter()
+    packed, used = [], 0
+    for passage in passages:
+        n_tokens = count_tokens(passage)
+        if used + n_tokens <= max_tokens:
+            packed.append(passage)
+            used += n_tokens
+            continue
+        remaining = max_tokens - used
+        if remaining >= MIN_TAIL_TOKENS:
+            packed.append(_truncate(passage, remaining, count_tokens))
+        break
+    return packed
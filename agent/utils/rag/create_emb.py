@@ -1,10 +1,194 @@
+import os
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
 from langchain_huggingface import HuggingFaceEmbeddings
 import torch
 
+from . import tracing
+
+
+def normalize_text(text: str) -> str:
+    # 全形轉半形、合併空白，讓同一個問題的不同寫法共用快取
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that caches query vectors.
+
+    Query embeddings are kept in a bounded in-memory LRU and, if `cache_path`
+    is given, in a SQLite store keyed by (model name, normalized text) that
+    survives restarts. Document embeddings are passed through untouched.
+    """
+
+    def __init__(self, base: Embeddings, model_name: str, max_size: int = 4096, cache_path: str = None):
+        self.base = base
+        self.model_name = model_name
+        self.max_size = max_size
+        self.cache_path = cache_path
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._lru = OrderedDict()  # {normalized text: list[float]}
+        self._db = None
+        if cache_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+            self._db = sqlite3.connect(cache_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS query_emb ("
+                "model TEXT, text TEXT, vector BLOB, PRIMARY KEY (model, text))"
+            )
+            self._db.commit()
+
+    def _get(self, key: str):
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                return self._lru[key]
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                "SELECT vector FROM query_emb WHERE model = ? AND text = ?",
+                (self.model_name, key),
+            ).fetchone()
+        if row is None:
+            return None
+        vector = np.frombuffer(row[0], dtype=np.float32).tolist()
+        self._put(key, vector, persist=False)
+        return vector
+
+    def _put(self, key: str, vector: list[float], persist: bool = True) -> None:
+        with self._lock:
+            if self.max_size > 0:
+                self._lru[key] = vector
+                self._lru.move_to_end(key)
+                while len(self._lru) > self.max_size:
+                    self._lru.popitem(last=False)
+            if persist and self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO query_emb VALUES (?, ?, ?)",
+                    (self.model_name, key, np.asarray(vector, dtype=np.float32).tobytes()),
+                )
+                self._db.commit()
+
+    def embed_query(self, text: str) -> list[float]:
+        key = normalize_text(text)
+        vector = self._get(key)
+        if vector is not None:
+            self.hits += 1
+            return vector
+        self.misses += 1
+        # 正規化只用於快取 key，模型仍 embed 使用者原本的 query
+        # 以 float32 儲存，記憶體與磁碟快取回傳的值一致
+        with tracing.span("query_embedding"):
+            vector = np.asarray(self.base.embed_query(text), dtype=np.float32).tolist()
+        self._put(key, vector)
+        return vector
+
+    def embed_queries(self, texts: list[str], batch_size: int = 64) -> list[list[float]]:
+        """
+        Embed many queries at once: cached ones are looked up, the rest are
+        encoded in batches (with the model's query prompt / kwargs) and cached.
+        """
+        keys = [normalize_text(t) for t in texts]
+        vectors = {}
+        for key in keys:
+            vector = self._get(key)
+            if vector is not None:
+                vectors[key] = vector
+        # {key: 第一個對應的原始 query}；embed 原文，key 只用於快取
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            client = _sentence_transformer(self.base)
+            if client is None:
+                computed = [self.base.embed_query(t) for t in missing.values()]
+            else:
+                # 與 HuggingFaceEmbeddings.embed_query 相同的 encode 參數
+                kwargs = dict(getattr(self.base, "query_encode_kwargs", None) or getattr(self.base, "encode_kwargs", None) or {})
+                kwargs.setdefault("batch_size", batch_size)
+                # 與 embed_query 相同的前處理，單筆與批次得到相同的向量
+                query_texts = [t.replace("\n", " ") for t in missing.values()]
+                computed = client.encode(query_texts, show_progress_bar=False, **kwargs)
+            for key, vector in zip(missing, computed):
+                vector = np.asarray(vector, dtype=np.float32).tolist()
+                self._put(key, vector)
+                vectors[key] = vector
+        return [vectors[k] for k in keys]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.base.embed_documents(texts)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "memory_entries": len(self._lru),
+        }
+
+
+def _sentence_transformer(embedding_model: Embeddings):
+    # HuggingFaceEmbeddings 內部的 SentenceTransformer；其他 Embeddings 回傳 None
+    base = getattr(embedding_model, "base", embedding_model)
+    return getattr(base, "_client", None)
+
+
+def start_encode_pool(embedding_model: Embeddings, n_workers: int):
+    """
+    Start a multi-process CPU encode pool for corpus embedding (None if unsupported).
+    """
+    client = _sentence_transformer(embedding_model)
+    if client is None or n_workers <= 1:
+        return None
+    return client.start_multi_process_pool(["cpu"] * n_workers)
+
+
+def stop_encode_pool(embedding_model: Embeddings, pool) -> None:
+    if pool is not None:
+        _sentence_transformer(embedding_model).stop_multi_process_pool(pool)
+
+
+def encode_documents(
+    embedding_model: Embeddings,
+    texts: list[str],
+    batch_size: int = 32,
+    pool=None,
+) -> list[list[float]]:
+    """
+    Embed documents with an explicit batch size, optionally on a multi-process pool.
+    Falls back to `embed_documents` for non sentence-transformers models.
+    """
+    client = _sentence_transformer(embedding_model)
+    if client is None:
+        return embedding_model.embed_documents(texts)
+
+    # 與 HuggingFaceEmbeddings 相同的前處理
+    texts = [t.replace("\n", " ") for t in texts]
+    if pool is not None:
+        vectors = client.encode_multi_process(texts, pool, batch_size=batch_size)
+    else:
+        vectors = client.encode(texts, batch_size=batch_size, show_progress_bar=False)
+    return vectors.tolist()
+
 
-def get_embedding_model(model_name: str):
+@tracing.traced("embedder_load")
+def get_embedding_model(model_name: str, cache_size: int = 4096, cache_path: str = None) -> CachedEmbeddings:
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    return HuggingFaceEmbeddings(
+    base = HuggingFaceEmbeddings(
         model_name=model_name,
         model_kwargs={"device": device, "trust_remote_code": True},
-    )
\ No newline at end of file
+    )
+    return CachedEmbeddings(base, model_name, max_size=cache_size, cache_path=cache_path)
@@ -0,0 +1,104 @@
+import json
+import mmap
+from pathlib import Path
+from typing import Dict, List, Union
+
+import numpy as np
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
+
+DOCS_NAME = "docs.jsonl"           # one {"page_content", "metadata"} record per line, in faiss row order
+OFFSETS_NAME = "docs_offsets.npy"  # int64 byte offsets of every line (+ end of file)
+IDS_NAME = "ids.json"              # docstore id of every faiss row
+
+
+def write_doc_store(
+    docstore: Docstore,
+    index_to_docstore_id: Dict[int, str],
+    index_dir: str,
+) -> None:
+    """
+    Write the documents of a vectorstore as JSON lines plus an offset table,
+    in faiss row order, so they can be read back one by one without unpickling.
+    """
+    index_path = Path(index_dir)
+    ids = [index_to_docstore_id[i] for i in range(len(index_to_docstore_id))]
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    with open(index_path / DOCS_NAME, "wb") as f:
+        for row, doc_id in enumerate(ids):
+            doc = docstore.search(doc_id)
+            line = json.dumps(
+                {"page_content": doc.page_content, "metadata": doc.metadata},
+                ensure_ascii=False,
+            ).encode("utf-8") + b"\n"
+            f.write(line)
+            offsets[row + 1] = offsets[row] + len(line)
+    np.save(index_path / OFFSETS_NAME, offsets)
+    with open(index_path / IDS_NAME, "w", encoding="utf-8") as f:
+        json.dump(ids, f, ensure_ascii=False)
+
+
+def has_doc_store(index_dir: str) -> bool:
+    index_path = Path(index_dir)
+    return all((index_path / name).exists() for name in (DOCS_NAME, OFFSETS_NAME, IDS_NAME))
+
+
+def load_ids(index_dir: str) -> List[str]:
+    with open(Path(index_dir) / IDS_NAME, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def iter_records(index_dir: str):
+    with open(Path(index_dir) / DOCS_NAME, "r", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def load_docstore(index_dir: str, ids: List[str] = None) -> InMemoryDocstore:
+    """
+    Load every document into a mutable in-memory docstore (for index updates).
+    """
+    if ids is None:
+        ids = load_ids(index_dir)
+    return InMemoryDocstore({
+        doc_id: Document(id=doc_id, page_content=record["page_content"], metadata=record["metadata"])
+        for doc_id, record in zip(ids, iter_records(index_dir))
+    })
+
+
+class LazyDocStore(Docstore):
+    """
+    Read-only docstore over the files written by `write_doc_store`.
+
+    docs.jsonl is memory-mapped, so processes serving the same index share
+    its pages through the OS page cache, and a document is only decoded when
+    a search returns it.
+    """
+
+    def __init__(self, index_dir: str, ids: List[str] = None):
+        index_path = Path(index_dir)
+        if ids is None:
+            ids = load_ids(index_dir)
+        self._rows = {doc_id: row for row, doc_id in enumerate(ids)}
+        self._offsets = np.load(index_path / OFFSETS_NAME, mmap_mode="r")
+        with open(index_path / DOCS_NAME, "rb") as f:
+            # 空檔案無法 mmap
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self._offsets[-1] > 0 else b""
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def search(self, search: str) -> Union[str, Document]:
+        row = self._rows.get(search)
+        if row is None:
+            return f"ID {search} not found."
+        start, end = int(self._offsets[row]), int(self._offsets[row + 1])
+        record = json.loads(self._data[start:end])
+        return Document(id=search, page_content=record["page_content"], metadata=record["metadata"])
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        raise NotImplementedError("LazyDocStore is read-only; update the index with process_faiss_idx")
+
+    def delete(self, ids: List) -> None:
+        raise NotImplementedError("LazyDocStore is read-only; update the index with process_faiss_idx")
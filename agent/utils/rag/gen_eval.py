@@ -0,0 +1,230 @@
+"""
+Concurrent generation + LLM-judge evaluation against OpenRouter.
+
+Requests share one token bucket that halves its rate on every 429 (and
+pauses for Retry-After), then creeps back up on success; failed calls are
+retried with exponential backoff. Finished questions are appended to a
+JSONL checkpoint, so an interrupted run resumes where it stopped.
+
+script/fake_openrouter.py starts a fake OpenAI-compatible server for local
+testing of the evaluator and the serving LLM client.
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import email.utils
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import openai
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class AsyncTokenBucket:
+    """
+    Token bucket with additive-increase / multiplicative-decrease rate.
+
+    rate: Requests per second (also the ceiling the rate recovers to).
+    capacity: Burst size.
+    """
+
+    def __init__(self, rate: float, capacity: float = None, min_rate: float = 0.02):
+        if rate <= 0:
+            raise ValueError(f"Request rate must be positive, got {rate}")
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.n_rate_limited = 0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self) -> None:
+        self.rate = min(self.max_rate, self.rate + 0.05 * self.max_rate)
+
+    def on_rate_limited(self, retry_after: float = None) -> None:
+        self.n_rate_limited += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0.0
+        if retry_after:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+
+def retry_after_seconds(exc: Exception) -> Optional[float]:
+    """
+    Seconds to wait according to Retry-After (or OpenRouter's X-RateLimit-Reset, epoch ms).
+    """
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    reset = headers.get("x-ratelimit-reset")
+    if reset:
+        try:
+            return max(0.0, int(reset) / 1000 - time.time())
+        except ValueError:
+            pass
+    return None
+
+
+def is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return getattr(exc, "status_code", None) in RETRYABLE_STATUS
+
+
+async def call_with_backoff(
+    fn: Callable[[], Awaitable[Any]],
+    bucket: AsyncTokenBucket,
+    max_retries: int = 6,
+    base_delay: float = 2.0,
+    max_delay: float = 120.0,
+) -> Any:
+    for attempt in range(max_retries + 1):
+        await bucket.acquire()
+        try:
+            result = await fn()
+        except Exception as e:
+            if not is_retryable(e) or attempt == max_retries:
+                raise
+            retry_after = retry_after_seconds(e)
+            if getattr(e, "status_code", None) == 429:
+                bucket.on_rate_limited(retry_after)
+            if retry_after is None:
+                retry_after = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            await asyncio.sleep(retry_after)
+            continue
+        bucket.on_success()
+        return result
+
+
+class GenerationEvaluator:
+    """
+    Run `chain` on every question and grade the answer with `judger`.
+
+    Args:
+        chain: Generation runnable (question -> answer).
+        judger: Judge runnable ({"question", "answer"} -> str, or LLMChain dict output).
+        concurrency: Max questions in flight.
+        rate: Max requests per second (generation and judge calls share it).
+        checkpoint_path: JSONL file of finished questions (None: no checkpoint).
+        max_retries: Retries per request.
+    """
+
+    def __init__(
+        self,
+        chain: Any,
+        judger: Any,
+        concurrency: int = 4,
+        rate: float = 0.3,
+        checkpoint_path: str = None,
+        max_retries: int = 6,
+    ):
+        self.chain = chain
+        self.judger = judger
+        self.concurrency = concurrency
+        self.bucket = AsyncTokenBucket(rate)
+        self.checkpoint_path = checkpoint_path
+        self.max_retries = max_retries
+
+    def load_checkpoint(self) -> Dict[str, dict]:
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return {}
+        done = {}
+        with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 中斷時寫到一半的最後一行
+                done[record["key"]] = record
+        return done
+
+    def _append_checkpoint(self, record: dict) -> None:
+        if not self.checkpoint_path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.checkpoint_path)), exist_ok=True)
+        with open(self.checkpoint_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    async def _judge(self, question: str, answer: str) -> str:
+        result = await self.judger.ainvoke({"question": question, "answer": answer})
+        return result["text"] if isinstance(result, dict) else result
+
+    async def _evaluate_one(self, item: dict) -> dict:
+        question = item["question"]
+        answer, evaluation, failed = "", None, False
+        try:
+            answer = await call_with_backoff(
+                lambda: self.chain.ainvoke(question), self.bucket, self.max_retries
+            )
+            evaluation = await call_with_backoff(
+                lambda: self._judge(question, answer), self.bucket, self.max_retries
+            )
+        except Exception as e:
+            evaluation = f"Error: {str(e)}"
+            failed = True
+        return {**item, "answer": answer, "evaluation": evaluation, "failed": failed}
+
+    async def evaluate(self, items: List[dict]) -> List[dict]:
+        """
+        items: [{"key": unique id, "question": str, ...}]; returns records in the same order.
+        """
+        done = self.load_checkpoint()
+        todo = [item for item in items if item["key"] not in done]
+        if done:
+            print(f"[GenEval] Resuming: {len(items) - len(todo)}/{len(items)} already evaluated")
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        start = time.perf_counter()
+        n_finished = 0
+
+        async def run(item: dict) -> None:
+            nonlocal n_finished
+            async with semaphore:
+                record = await self._evaluate_one(item)
+            n_finished += 1
+            done[item["key"]] = record
+            if not record["failed"]:
+                # 失敗的題目不寫入 checkpoint，下次會重跑
+                self._append_checkpoint(record)
+            print(f"[{n_finished}/{len(todo)}] 問題: {record['question']}")
+            print(f"回答: {record['answer']}")
+            print(f"評估結果: {record['evaluation']}")
+            print("=" * 50)
+
+        await asyncio.gather(*(run(item) for item in todo))
+
+        elapsed = time.perf_counter() - start
+        if todo:
+            print(
+                f"[GenEval] {len(todo)} questions in {elapsed:.1f}s "
+                f"({len(todo) / elapsed * 60:.1f} questions/min, "
+                f"{self.bucket.n_rate_limited} rate-limited responses, final rate {self.bucket.rate:.2f} req/s)"
+            )
+        return [done[item["key"]] for item in items]
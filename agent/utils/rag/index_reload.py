@@ -0,0 +1,111 @@
+import threading
+from typing import Any, Callable, List
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from . import tracing
+from .process_faiss_idx import get_index_version
+
+
+class LiveIndex:
+    """
+    A FAISS index that can be replaced while the process is serving.
+
+    `vectorstore` always points to a fully loaded index; a reload builds the new
+    vectorstore first and then swaps the reference, so requests that already
+    picked up the old one finish on it. With a `loader` / `get_version` of
+    sparse_idx, `vectorstore` holds a BM25 retriever instead.
+    """
+
+    def __init__(
+        self,
+        index_dir: str,
+        embeddings: object,
+        loader: Callable[[str, object], object],
+        get_version: Callable[[str], str] = get_index_version,
+    ):
+        self.index_dir = index_dir
+        self.embeddings = embeddings
+        self.loader = loader
+        self.get_version = get_version
+        self.version = get_version(index_dir)
+        self.vectorstore = loader(index_dir, embeddings)
+
+    def reload_if_changed(self) -> bool:
+        try:
+            version = self.get_version(self.index_dir)
+        except (OSError, ValueError, KeyError):
+            # index 正在被換掉，下一輪再檢查
+            return False
+        if version == self.version:
+            return False
+
+        vectorstore = self.loader(self.index_dir, self.embeddings)
+        self.vectorstore, self.version = vectorstore, version
+        print(f"[LiveIndex] Reloaded {self.index_dir} (version {version})")
+        return True
+
+
+class LiveRetriever(BaseRetriever):
+    """
+    Retriever that searches whatever index `live_index` currently holds.
+    """
+
+    live_index: Any
+    search_kwargs: dict = {}
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        # 只取一次引用：reload 發生時，進行中的請求仍使用舊 index
+        vectorstore = self.live_index.vectorstore
+        # embedding (span "query_embedding") 與 FAISS 搜尋分開計時
+        vector = vectorstore.embeddings.embed_query(query)
+        with tracing.span("faiss_search"):
+            return vectorstore.similarity_search_by_vector(vector, **self.search_kwargs)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        vectorstore = self.live_index.vectorstore
+        vector = await vectorstore.embeddings.aembed_query(query)
+        with tracing.span("faiss_search"):
+            return await vectorstore.asimilarity_search_by_vector(vector, **self.search_kwargs)
+
+
+class LiveSparseRetriever(BaseRetriever):
+    """
+    Retriever that queries whatever BM25 retriever `live_index` currently holds.
+    """
+
+    live_index: Any
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self.live_index.vectorstore.invoke(query, config={"callbacks": run_manager.get_child()})
+
+
+class IndexWatcher(threading.Thread):
+    """
+    Background thread polling version.json of every live index.
+    """
+
+    def __init__(self, get_indexes: Callable[[], List[LiveIndex]], interval: float = 10.0):
+        super().__init__(daemon=True, name="IndexWatcher")
+        self.get_indexes = get_indexes
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            for live_index in self.get_indexes():
+                try:
+                    live_index.reload_if_changed()
+                except Exception as e:
+                    print(f"[IndexWatcher] Failed to reload {live_index.index_dir}: {e!r}")
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,186 @@
+"""
+Spread OpenRouter requests over several API keys.
+
+`KeyPoolAuth` is an httpx auth hook: every outgoing request gets the key that
+currently has the most headroom (fewest requests in flight, most remaining
+quota), and every response updates that key's rate-limit window from the
+X-RateLimit-Remaining / X-RateLimit-Reset / Retry-After headers. Keys that
+answered 429 are skipped until their window resets; 401/402/403 (invalid key,
+no credits) take a key out for longer.
+"""
+import os
+import re
+import time
+import threading
+import email.utils
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import httpx
+
+DEFAULT_COOLDOWN = 10.0   # 429 但沒有 Retry-After / X-RateLimit-Reset 時
+DISABLED_COOLDOWN = 600.0  # 401 / 402 / 403
+
+
+def load_keys_from_env() -> List[str]:
+    """
+    OPENROUTER_API_KEYS (comma-separated) plus OPENROUTER_API_KEY, OPENROUTER_API_KEY2, ...
+    """
+    keys = [k.strip() for k in os.getenv("OPENROUTER_API_KEYS", "").split(",")]
+    numbered = sorted(
+        (int(m.group(1) or 1), value)
+        for name, value in os.environ.items()
+        if (m := re.fullmatch(r"OPENROUTER_API_KEY(\d*)", name))
+    )
+    keys += [value.strip() for _, value in numbered]
+    return [k for k in dict.fromkeys(keys) if k]
+
+
+def _float_header(headers: httpx.Headers, name: str) -> Optional[float]:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _ratelimit_reset(headers: httpx.Headers) -> Optional[float]:
+    # OpenRouter 的 X-RateLimit-Reset 為 epoch 毫秒
+    reset = _float_header(headers, "x-ratelimit-reset")
+    if reset is None:
+        return None
+    return reset / 1000 if reset > 1e11 else reset
+
+
+def reset_at(headers: httpx.Headers, now: float) -> Optional[float]:
+    """
+    Epoch seconds at which the key can be used again, from Retry-After or
+    X-RateLimit-Reset (OpenRouter: epoch milliseconds).
+    """
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return now + float(retry_after)
+        except ValueError:
+            try:
+                return email.utils.parsedate_to_datetime(retry_after).timestamp()
+            except (TypeError, ValueError):
+                pass
+    return _ratelimit_reset(headers)
+
+
+@dataclass
+class KeyState:
+    key: str
+    in_flight: int = 0
+    remaining: Optional[float] = None  # None: 尚未收到 X-RateLimit-Remaining
+    limit: Optional[float] = None
+    reset_at: float = 0.0              # remaining 歸零的 window 何時重置
+    cooldown_until: float = 0.0
+    n_requests: int = 0
+    n_rate_limited: int = 0
+
+    @property
+    def name(self) -> str:
+        return f"...{self.key[-4:]}"
+
+    def blocked_until(self, now: float) -> float:
+        until = self.cooldown_until
+        if self.remaining is not None and self.remaining <= 0 and self.reset_at > now:
+            until = max(until, self.reset_at)
+        return until
+
+
+class KeyPool:
+    def __init__(self, keys: List[str]):
+        if not keys:
+            raise ValueError("No OpenRouter API key configured (OPENROUTER_API_KEY / OPENROUTER_API_KEYS)")
+        self.states = [KeyState(key) for key in keys]
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def acquire(self) -> KeyState:
+        """
+        Key with the most headroom; if every key is exhausted, the one that resets first.
+        """
+        now = time.time()
+        with self._lock:
+            available = [s for s in self.states if s.blocked_until(now) <= now]
+            if available:
+                state = min(available, key=lambda s: (
+                    s.in_flight,
+                    -(s.remaining if s.remaining is not None else float("inf")),
+                    s.n_requests,
+                ))
+            else:
+                state = min(self.states, key=lambda s: s.blocked_until(now))
+            state.in_flight += 1
+            return state
+
+    def release(self, state: KeyState, response: Optional[httpx.Response]) -> None:
+        now = time.time()
+        with self._lock:
+            state.in_flight -= 1
+            state.n_requests += 1
+            if response is None:
+                return
+            headers = response.headers
+            remaining = _float_header(headers, "x-ratelimit-remaining")
+            if remaining is not None:
+                state.remaining = remaining
+                state.limit = _float_header(headers, "x-ratelimit-limit")
+                state.reset_at = _ratelimit_reset(headers) or 0.0
+
+            if response.status_code == 429:
+                state.n_rate_limited += 1
+                state.cooldown_until = max(state.cooldown_until, reset_at(headers, now) or now + DEFAULT_COOLDOWN)
+                print(f"[KeyPool] Key {state.name} rate-limited for {state.cooldown_until - now:.0f}s")
+            elif response.status_code in (401, 402, 403):
+                state.cooldown_until = now + DISABLED_COOLDOWN
+                print(f"[KeyPool] Key {state.name} rejected ({response.status_code}), disabled for {DISABLED_COOLDOWN:.0f}s")
+
+    def has_available(self) -> bool:
+        now = time.time()
+        with self._lock:
+            return any(s.blocked_until(now) <= now for s in self.states)
+
+    def stats(self) -> List[Dict]:
+        now = time.time()
+        with self._lock:
+            return [
+                {
+                    "key": s.name,
+                    "requests": s.n_requests,
+                    "rate_limited": s.n_rate_limited,
+                    "in_flight": s.in_flight,
+                    "remaining": s.remaining,
+                    "blocked_s": max(0.0, s.blocked_until(now) - now),
+                }
+                for s in self.states
+            ]
+
+
+class KeyPoolAuth(httpx.Auth):
+    """
+    httpx auth that signs each request with a key from `pool` (overrides the client's api_key).
+    """
+
+    def __init__(self, pool: KeyPool):
+        self.pool = pool
+
+    def auth_flow(self, request: httpx.Request):
+        state = self.pool.acquire()
+        request.headers["Authorization"] = f"Bearer {state.key}"
+        response = None
+        try:
+            response = yield request
+        finally:
+            self.pool.release(state, response)
+        if response.status_code == 429 and self.pool.has_available():
+            # 還有其他 key 可用：不必等這個 key 的 Retry-After，openai client 會短暫 backoff 後換 key 重試
+            for name in ("retry-after", "retry-after-ms"):
+                response.headers.pop(name, None)
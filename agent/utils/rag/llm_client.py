@@ -0,0 +1,149 @@
+"""
+Process-wide OpenRouter (OpenAI-compatible) chat models.
+
+All ChatOpenAI instances share one keep-alive httpx connection pool, and
+identical models are built only once. `get_llm` chains several models with
+ordered failover: when a model answers 429 / 5xx (after its own retries),
+the next one is tried. Models built without an explicit api_key spread their
+requests over every configured OpenRouter key (see key_pool).
+
+Configuration (environment):
+    LLM_CONNECT_TIMEOUT  seconds to open a connection (default 5)
+    LLM_READ_TIMEOUT     seconds to wait for response data (default 60)
+    LLM_MAX_CONNECTIONS  connection pool size (default 32)
+    LLM_KEEPALIVE_EXPIRY seconds an idle connection is kept open (default 120)
+"""
+import os
+import threading
+from typing import List, Sequence
+
+import httpx
+import openai
+from langchain_core.runnables import Runnable
+from langchain_openai import ChatOpenAI
+
+from .key_pool import KeyPool, KeyPoolAuth, load_keys_from_env
+
+# 可指向本地 fake server 測試 (script/fake_openrouter.py)
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+
+CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "60"))
+MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "32"))
+KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "120"))
+
+# 這些錯誤改用下一個模型；其他錯誤 (如 400/401) 換模型也不會成功
+FAILOVER_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+# key pool 模式時傳給 openai client 的 api_key；實際的 key 由 KeyPoolAuth 在每個請求設定
+POOLED_API_KEY = "key-pool"
+
+_lock = threading.Lock()
+_key_pool = None
+_http_clients = {}  # {(is_async, pooled): httpx.Client / httpx.AsyncClient}
+_chat_models = {}   # {(model, api_key, temperature, max_retries, read_timeout): ChatOpenAI}
+
+
+def get_timeout(read_timeout: float = None) -> httpx.Timeout:
+    return httpx.Timeout(read_timeout or READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+
+def get_key_pool() -> KeyPool:
+    """
+    Process-wide pool of the OpenRouter keys found in the environment.
+    """
+    global _key_pool
+    with _lock:
+        if _key_pool is None:
+            _key_pool = KeyPool(load_keys_from_env())
+            print(f"[LLM] OpenRouter key pool with {len(_key_pool)} key(s)")
+        return _key_pool
+
+
+def get_http_client(pooled: bool = False, is_async: bool = False):
+    """
+    Shared keep-alive connection pool for the LLM calls of this process.
+
+    `pooled` signs every request with a key of `get_key_pool()`. The async
+    client is bound to the event loop that first uses it (one asyncio.run per process).
+    """
+    auth = KeyPoolAuth(get_key_pool()) if pooled else None
+    with _lock:
+        key = (is_async, pooled)
+        if key not in _http_clients:
+            client_cls = httpx.AsyncClient if is_async else httpx.Client
+            _http_clients[key] = client_cls(
+                timeout=get_timeout(),
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_CONNECTIONS,
+                    keepalive_expiry=KEEPALIVE_EXPIRY,
+                ),
+                auth=auth,
+            )
+        return _http_clients[key]
+
+
+def get_chat_model(
+    model: str,
+    api_key: str = None,
+    temperature: float = 0.1,
+    max_retries: int = 2,
+    read_timeout: float = None,
+) -> ChatOpenAI:
+    """
+    Cached ChatOpenAI on the shared connection pool.
+
+    `api_key` None uses the key pool. `max_retries` retries 408/409/429/5xx
+    and connection errors with exponential backoff and jitter (honoring
+    Retry-After), inside the openai client; with the key pool a retry after
+    429 goes out with another key.
+    """
+    key = (model, api_key, temperature, max_retries, read_timeout)
+    pooled = api_key is None
+    http_client = get_http_client(pooled)
+    http_async_client = get_http_client(pooled, is_async=True)
+    with _lock:
+        if key not in _chat_models:
+            _chat_models[key] = ChatOpenAI(
+                model=model,
+                base_url=OPENROUTER_BASE_URL,
+                api_key=POOLED_API_KEY if pooled else api_key,
+                temperature=temperature,
+                max_retries=max_retries,
+                timeout=get_timeout(read_timeout),
+                http_client=http_client,
+                http_async_client=http_async_client,
+                # 串流時也回傳 token 用量 (tracing)
+                stream_usage=True,
+            )
+        return _chat_models[key]
+
+
+def get_llm(
+    models: Sequence[str],
+    api_key: str = None,
+    temperature: float = 0.1,
+    max_retries: int = 2,
+    failover_retries: int = 0,
+    read_timeout: float = None,
+) -> Runnable:
+    """
+    Chat model with ordered failover across `models`.
+
+    Every model but the last is retried only `failover_retries` times before
+    moving on (free-tier 429s often come with long Retry-After waits); the
+    last model gets the full `max_retries`.
+    """
+    models: List[str] = [m for m in dict.fromkeys(models) if m]
+    llms = [
+        get_chat_model(
+            model, api_key, temperature,
+            max_retries if i == len(models) - 1 else failover_retries,
+            read_timeout,
+        )
+        for i, model in enumerate(models)
+    ]
+    if len(llms) == 1:
+        return llms[0]
+    return llms[0].with_fallbacks(llms[1:], exceptions_to_handle=FAILOVER_ERRORS)
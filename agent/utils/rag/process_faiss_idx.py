@@ -1,49 +1,75 @@
 import os
 import json
+import time
+import uuid
+import shutil
+import hashlib
+import warnings
+import itertools
+import multiprocessing
 import torch
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
 from pathlib import Path
-from typing import Iterable, List
+from typing import Dict, Iterable, Iterator, List, Tuple
+import faiss
+import numpy as np
 import pandas as pd
+from tqdm import tqdm
 from langchain_core.documents import Document
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain.embeddings.base import Embeddings  # interface
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-def load_csvfile(path: Path):
-    # Read CSV
-    df = pd.read_csv(path, encoding="utf-8")
+from . import create_emb, doc_store
+
+MANIFEST_NAME = "files.json"   # incremental build: per-file / per-chunk hashes
+VERSION_NAME = "version.json"  # changes on every save; watched by serving processes
+INDEX_CONFIG_NAME = "index.json"  # index type / metric of a non-default index, read by load_index
+
+INDEX_TYPES = ("flat", "ivf", "hnsw", "pq", "ivfpq")
 
-    required_cols = ["question", "answer", "source", "class", "uuid"]
+# 唯讀 mmap：多個 backend worker 透過 page cache 共用同一份 index
+# (IO_FLAG_MMAP_IFC 也涵蓋 flat index 的向量；舊版 faiss 只有 IO_FLAG_MMAP)
+MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+CSV_REQUIRED_COLS = ["question", "answer", "source", "class", "uuid"]
+
+def iter_csvfile(path: Path, rows_per_read: int = 1000) -> Iterator[Document]:
+    """
+    Stream a Q/A CSV row by row, reading `rows_per_read` rows at a time.
+    """
+    required_cols = CSV_REQUIRED_COLS
     page_content_col = "answer"
     metadata_cols = ["question", "class", "source", "uuid"]
 
-    # Ensure all required columns are present
-    missing = set(required_cols) - set(df.columns)
-    if missing:
-        raise KeyError(f"{path} missing columns: {sorted(missing)}")
-
-    # Clean missing values and convert all to string
-    df = df[required_cols].fillna("").astype(str)
-
-    # Convert each row into a Document
-    docs = []
-    for row in df[required_cols].itertuples(index=False, name=None):
-        metadata = {}
-        for col_name, item in zip(required_cols, row):
-            if col_name in metadata_cols:
-                metadata[col_name] = item
-            elif col_name == page_content_col:
-                a = item
-
-        page_content = f"Q:{metadata['question']}\nA:{a}"
-        docs.append(
-            Document(
+    for df in pd.read_csv(path, encoding="utf-8", chunksize=rows_per_read):
+        # Ensure all required columns are present
+        missing = set(required_cols) - set(df.columns)
+        if missing:
+            raise KeyError(f"{path} missing columns: {sorted(missing)}")
+
+        # Clean missing values and convert all to string
+        df = df[required_cols].fillna("").astype(str)
+
+        # Convert each row into a Document
+        for row in df[required_cols].itertuples(index=False, name=None):
+            metadata = {}
+            for col_name, item in zip(required_cols, row):
+                if col_name in metadata_cols:
+                    metadata[col_name] = item
+                elif col_name == page_content_col:
+                    a = item
+
+            page_content = f"Q:{metadata['question']}\nA:{a}"
+            yield Document(
                 page_content=page_content,
                 metadata=metadata
             )
-        )
 
-    return docs
+def load_csvfile(path: Path):
+    return list(iter_csvfile(path))
 
 def load_jsonfile(path: Path):
     '''
@@ -68,6 +94,46 @@ def load_jsonfile(path: Path):
 
     return doc
 
+def iter_file(path: str) -> Iterator[Document]:
+    """
+    Stream the Documents of one .csv or .json file.
+    """
+    p = Path(path)
+    if p.suffix.lower() == ".csv":
+        yield from iter_csvfile(p)
+    elif p.suffix.lower() == ".json":
+        yield load_jsonfile(p)
+    else:
+        raise ValueError(f"Unsupported file format: {p}. Only .csv and .json are supported.")
+
+def load_file(path: str) -> List[Document]:
+    """
+    Load one .csv or .json file into Documents.
+    """
+    return list(iter_file(path))
+
+def iter_docs(files: Iterable[str], n_workers: int = 1, chunksize: int = 16) -> Iterator[Document]:
+    """
+    Stream Documents from many files, in file order.
+
+    With `n_workers` > 1, files are parsed in a process pool (useful for the many
+    small JSON notes from webfile2json.py). Files are submitted in windows of
+    `n_workers * chunksize`, and the next window starts only after the consumer
+    has taken the current one, so at most one window of parsed files is buffered.
+    """
+    if n_workers <= 1:
+        for path in files:
+            yield from iter_file(path)
+        return
+
+    # Pool.imap 會一次送出所有檔案、結果無上限地排隊；分批送出才能限制記憶體
+    window = n_workers * chunksize
+    files = iter(files)
+    with multiprocessing.Pool(n_workers) as pool:
+        while batch := list(itertools.islice(files, window)):
+            for docs in pool.imap(load_file, batch, chunksize=chunksize):
+                yield from docs
+
 def load_doc(files: Iterable[str]) -> List[Document]:
     """
     Load Q/A rows from CSV files and convert them to LangChain Documents.
@@ -75,16 +141,7 @@ def load_doc(files: Iterable[str]) -> List[Document]:
     """
     docs_all: List[Document] = []
     for path in files:
-        p = Path(path)
-        if p.suffix.lower() == ".csv":
-            docs = load_csvfile(p)
-            for doc in docs:
-                docs_all.append(doc)
-        elif p.suffix.lower() == ".json":
-            doc = load_jsonfile(p)
-            docs_all.append(doc)
-        else:
-            raise ValueError(f"Unsupported file format: {p}. Only .csv and .json are supported.")
+        docs_all.extend(load_file(path))
 
     return docs_all
 
@@ -98,29 +155,865 @@ def split(docs: List[Document], chunk_size: int = 512) -> List[Document]:
     all_splits = text_splitter.split_documents(docs)
     return all_splits
 
-def build_new_index(docs: List[Document], index_dir: str, embedding_model: Embeddings) -> FAISS:
+def iter_chunks(docs: Iterable[Document], chunk_size: int = 512) -> Iterator[Tuple[Document, str]]:
+    """
+    Split Documents one at a time and yield (chunk, id) pairs, where the id
+    "<uuid>:<chunk index>" stays the same across index builds.
+    """
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=200)
+    for doc in docs:
+        doc_id = doc.metadata.get("uuid") or hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()
+        for i, chunk in enumerate(text_splitter.split_documents([doc])):
+            yield chunk, f"{doc_id}:{i}"
+
+def split_with_ids(docs: List[Document], chunk_size: int = 512) -> Tuple[List[Document], List[str]]:
+    """
+    Split Documents and give every chunk a stable id "<uuid>:<chunk index>",
+    so the same chunk keeps its id across index builds.
+    """
+    chunks, ids = [], []
+    for chunk, chunk_id in iter_chunks(docs, chunk_size):
+        chunks.append(chunk)
+        ids.append(chunk_id)
+    return chunks, ids
+
+def embed_texts(
+    texts: List[str],
+    embedding_model: Embeddings,
+    batch_size: int = 32,
+    n_workers: int = 1,
+) -> List[List[float]]:
+    """
+    Embed a corpus in length-sorted batches and report throughput.
+
+    Sorting by length groups similar-length chunks into the same batch, which
+    minimizes padding. With `n_workers` > 1, batches are encoded on a
+    multi-process CPU pool.
+
+    Returns:
+        Vectors in the same order as `texts`.
+    """
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    vectors: List[List[float]] = [None] * len(texts)
+    # 一次送給 encoder 的量：每個 worker 多個 batch，減少 pool 的調度成本
+    step = batch_size * max(n_workers, 1) * 4
+
+    pool = create_emb.start_encode_pool(embedding_model, n_workers)
+    start = time.time()
+    try:
+        with tqdm(total=len(texts), desc="Embedding", unit="chunk") as pbar:
+            for s in range(0, len(order), step):
+                idx = order[s:s + step]
+                batch_vectors = create_emb.encode_documents(
+                    embedding_model, [texts[i] for i in idx], batch_size=batch_size, pool=pool
+                )
+                for i, vec in zip(idx, batch_vectors):
+                    vectors[i] = vec
+                pbar.update(len(idx))
+    finally:
+        create_emb.stop_encode_pool(embedding_model, pool)
+
+    elapsed = time.time() - start
+    print(f"[✓] Embedded {len(texts)} chunks in {elapsed:.1f}s ({len(texts) / max(elapsed, 1e-9):.1f} chunks/s)")
+    return vectors
+
+class ChunkDeduplicator:
+    """
+    Drop duplicate chunks before they enter the index.
+
+    A chunk is a duplicate if its whitespace-normalized text was already seen
+    (exact) or its embedding has cosine similarity >= `threshold` with a kept
+    chunk (near). The kept (canonical) chunk collects the `uuids` and `sources`
+    of every chunk merged into it.
+    """
+
+    def __init__(self, threshold: float = 0.97):
+        self.threshold = threshold
+        self.texts: List[str] = []
+        self.vectors: List[np.ndarray] = []
+        self.metadatas: List[dict] = []
+        self.ids: List[str] = []
+        self.n_seen = 0
+        self.n_exact = 0
+        self.n_near = 0
+        self._hashes: Dict[str, int] = {}
+        self._index = None  # IndexFlatIP over normalized kept vectors
+
+    def _merge(self, i: int, metadata: dict) -> None:
+        canon = self.metadatas[i]
+        if "uuids" not in canon:
+            canon["uuids"] = [canon["uuid"]] if canon.get("uuid") else []
+            source = canon.get("source") or canon.get("url")
+            canon["sources"] = [source] if source else []
+        uuid_ = metadata.get("uuid")
+        if uuid_ and uuid_ not in canon["uuids"]:
+            canon["uuids"].append(uuid_)
+        source = metadata.get("source") or metadata.get("url")
+        if source and source not in canon["sources"]:
+            canon["sources"].append(source)
+
+    def add(self, text: str, vector: List[float], metadata: dict, chunk_id: str) -> bool:
+        """
+        Returns True if the chunk is kept, False if it was merged into a kept one.
+        """
+        self.n_seen += 1
+        h = content_hash(" ".join(text.split()))
+        if h in self._hashes:
+            self._merge(self._hashes[h], metadata)
+            self.n_exact += 1
+            return False
+
+        vector = np.asarray(vector, dtype=np.float32)
+        unit = (vector / (np.linalg.norm(vector) + 1e-12)).reshape(1, -1)
+        if self._index is None:
+            self._index = faiss.IndexFlatIP(unit.shape[1])
+        elif self._index.ntotal > 0:
+            scores, idx = self._index.search(unit, 1)
+            if scores[0, 0] >= self.threshold:
+                self._merge(int(idx[0, 0]), metadata)
+                self._hashes[h] = int(idx[0, 0])
+                self.n_near += 1
+                return False
+
+        self._index.add(unit)
+        self._hashes[h] = len(self.texts)
+        self.texts.append(text)
+        self.vectors.append(vector)
+        self.metadatas.append(dict(metadata))
+        self.ids.append(chunk_id)
+        return True
+
+    def merge_if_seen(self, text: str, metadata: dict) -> bool:
+        """
+        Merge the chunk if its text was already added (exact duplicate), so it
+        does not need an embedding. Returns True if it was merged.
+        """
+        h = content_hash(" ".join(text.split()))
+        if h not in self._hashes:
+            return False
+        self._merge(self._hashes[h], metadata)
+        self.n_seen += 1
+        self.n_exact += 1
+        return True
+
+    def merge_exact(self, text: str, metadatas: List[dict]) -> None:
+        """
+        Count `metadatas` as exact duplicates of the already added chunk `text`
+        (dropped before embedding, see `drop_exact_duplicates`).
+        """
+        i = self._hashes[content_hash(" ".join(text.split()))]
+        for metadata in metadatas:
+            self._merge(i, metadata)
+        self.n_seen += len(metadatas)
+        self.n_exact += len(metadatas)
+
+    def report(self) -> None:
+        kept = len(self.texts)
+        shrink = 1 - kept / self.n_seen if self.n_seen else 0.0
+        print(
+            f"[✓] Dedup: {self.n_seen} -> {kept} chunks "
+            f"(exact: {self.n_exact}, near: {self.n_near}); index shrank by {shrink:.1%}"
+        )
+
+    def to_vectorstore(self, embedding_model: Embeddings) -> FAISS:
+        if not self.texts:
+            raise ValueError("No documents provided; abort building index.")
+        self.report()
+        return FAISS.from_embeddings(
+            list(zip(self.texts, [v.tolist() for v in self.vectors])),
+            embedding_model,
+            metadatas=self.metadatas,
+            ids=self.ids,
+        )
+
+def from_documents_batched(
+    docs: List[Document],
+    embedding_model: Embeddings,
+    ids: List[str] = None,
+    batch_size: int = 32,
+    n_workers: int = 1,
+    dedup_threshold: float = None,
+) -> FAISS:
+    """
+    Same as `FAISS.from_documents`, but embeds with `embed_texts`.
+    With `dedup_threshold`, duplicate chunks are merged (see `ChunkDeduplicator`).
+    """
+    texts = [d.page_content for d in docs]
+    metadatas = [d.metadata for d in docs]
+    if dedup_threshold is not None:
+        # 完全相同的文字先去掉，不必 embedding
+        first_of: Dict[str, int] = {}
+        hashes = []
+        for i, text in enumerate(texts):
+            h = content_hash(" ".join(text.split()))
+            first_of.setdefault(h, i)
+            hashes.append(h)
+        unique = sorted(first_of.values())
+        vectors = embed_texts([texts[i] for i in unique], embedding_model, batch_size=batch_size, n_workers=n_workers)
+        vector_of = dict(zip(unique, vectors))
+
+        dedup = ChunkDeduplicator(dedup_threshold)
+        for i, text in enumerate(texts):
+            # exact duplicate 沿用第一次出現的向量，在 hash 階段就會被合併
+            vector = vector_of[first_of[hashes[i]]]
+            dedup.add(text, vector, metadatas[i], ids[i] if ids else str(uuid.uuid4()))
+        return dedup.to_vectorstore(embedding_model)
+
+    vectors = embed_texts(texts, embedding_model, batch_size=batch_size, n_workers=n_workers)
+    return FAISS.from_embeddings(
+        list(zip(texts, vectors)),
+        embedding_model,
+        metadatas=metadatas,
+        ids=ids,
+    )
+
+def from_chunks_batched(
+    chunks: Iterable[Tuple[Document, str]],
+    embedding_model: Embeddings,
+    batch_size: int = 32,
+    n_workers: int = 1,
+    dedup_threshold: float = None,
+    window: int = 4096,
+) -> FAISS:
+    """
+    Streaming version of `from_documents_batched` for (chunk, id) pairs.
+
+    Chunks are embedded `window` at a time and appended to the index, so apart
+    from the index itself (vectors + docstore) memory does not grow with the corpus.
+    """
+    dedup = ChunkDeduplicator(dedup_threshold) if dedup_threshold is not None else None
+    vectorstore = None
+    chunks = iter(chunks)
+    while window_chunks := list(itertools.islice(chunks, window)):
+        if dedup is not None:
+            # 之前的 window 已有相同文字：直接合併，不必 embedding
+            window_chunks = [(c, i) for c, i in window_chunks if not dedup.merge_if_seen(c.page_content, c.metadata)]
+        texts = [c.page_content for c, _ in window_chunks]
+        metadatas = [c.metadata for c, _ in window_chunks]
+        ids = [i for _, i in window_chunks]
+        if dedup is not None:
+            # window 內完全相同的文字只 embedding 第一次出現的
+            first_of: Dict[str, int] = {}
+            hashes = [content_hash(" ".join(text.split())) for text in texts]
+            for i, h in enumerate(hashes):
+                first_of.setdefault(h, i)
+            unique = sorted(first_of.values())
+            vectors = embed_texts([texts[i] for i in unique], embedding_model, batch_size=batch_size, n_workers=n_workers)
+            vector_of = dict(zip(unique, vectors))
+            for i, text in enumerate(texts):
+                dedup.add(text, vector_of[first_of[hashes[i]]], metadatas[i], ids[i])
+            continue
+
+        vectors = embed_texts(texts, embedding_model, batch_size=batch_size, n_workers=n_workers)
+        if vectorstore is None:
+            vectorstore = FAISS.from_embeddings(list(zip(texts, vectors)), embedding_model, metadatas=metadatas, ids=ids)
+        else:
+            vectorstore.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas, ids=ids)
+
+    if dedup is not None:
+        return dedup.to_vectorstore(embedding_model)
+    if vectorstore is None:
+        raise ValueError("No documents provided; abort building index.")
+    return vectorstore
+
+@dataclass
+class IndexSpec:
+    """
+    FAISS index type of a build.
+
+    index_type: "flat" (exact), "ivf", "hnsw", "pq" or "ivfpq".
+    metric: "l2", or "ip" (inner product on L2-normalized vectors, i.e. cosine).
+    nlist: Number of IVF lists (0: 4 * sqrt(n_vectors)).
+    pq_m: Number of PQ sub-quantizers (must divide the embedding dimension).
+    hnsw_m: Number of HNSW neighbors per node.
+    train_size: Max number of vectors sampled to train IVF / PQ.
+    """
+
+    index_type: str = "flat"
+    metric: str = "l2"
+    nlist: int = 0
+    pq_m: int = 16
+    hnsw_m: int = 32
+    train_size: int = 50000
+
+    def is_default(self) -> bool:
+        return self.index_type == "flat" and self.metric == "l2"
+
+def index_factory_string(spec: IndexSpec, dim: int, n_vectors: int) -> str:
+    if spec.index_type not in INDEX_TYPES:
+        raise ValueError(f"Unsupported index type: {spec.index_type}")
+    if spec.index_type in ("pq", "ivfpq"):
+        if dim % spec.pq_m != 0:
+            raise ValueError(f"pq_m={spec.pq_m} does not divide the embedding dimension {dim}")
+        if n_vectors < 256:
+            raise ValueError(f"PQ needs at least 256 vectors to train, got {n_vectors}")
+
+    if spec.index_type == "flat":
+        return "Flat"
+    if spec.index_type == "hnsw":
+        return f"HNSW{spec.hnsw_m}"
+    if spec.index_type == "pq":
+        return f"PQ{spec.pq_m}"
+
+    nlist = spec.nlist or int(4 * np.sqrt(n_vectors))
+    # faiss 建議每個 centroid 至少 39 個訓練向量
+    nlist = max(1, min(nlist, n_vectors // 39))
+    if spec.index_type == "ivf":
+        return f"IVF{nlist},Flat"
+    return f"IVF{nlist},PQ{spec.pq_m}"
+
+@contextmanager
+def _cosine_warning_ignored():
+    # LangChain 對 inner product + normalize_L2 發出警告，但仍會正規化 query，正是 cosine 需要的
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="Normalizing L2 is not applicable")
+        yield
+
+def convert_index(vectorstore: FAISS, spec: IndexSpec) -> Tuple[FAISS, dict]:
+    """
+    Rebuild the (flat) index of `vectorstore` as the index type of `spec`.
+
+    Vectors are read back from the built index, normalized for "ip", and the
+    new index is trained on a random sample of at most `spec.train_size`
+    vectors. The docstore and ids are shared with `vectorstore`.
+
+    Returns:
+        (FAISS vectorstore, index config to save as index.json)
+    """
+    n_vectors = vectorstore.index.ntotal
+    vectors = vectorstore.index.reconstruct_n(0, n_vectors)
+    if spec.metric == "ip":
+        faiss.normalize_L2(vectors)
+
+    factory = index_factory_string(spec, vectors.shape[1], n_vectors)
+    metric = faiss.METRIC_INNER_PRODUCT if spec.metric == "ip" else faiss.METRIC_L2
+    index = faiss.index_factory(vectors.shape[1], factory, metric)
+    if not index.is_trained:
+        sample = vectors
+        if n_vectors > spec.train_size:
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(n_vectors, spec.train_size, replace=False)]
+        start = time.perf_counter()
+        index.train(sample)
+        print(f"[✓] Trained {factory} on {len(sample)} vectors in {time.perf_counter() - start:.1f}s")
+    index.add(vectors)
+
+    with _cosine_warning_ignored():
+        converted = FAISS(
+            embedding_function=vectorstore.embedding_function,
+            index=index,
+            docstore=vectorstore.docstore,
+            index_to_docstore_id=vectorstore.index_to_docstore_id,
+            normalize_L2=spec.metric == "ip",
+            distance_strategy=(
+                DistanceStrategy.MAX_INNER_PRODUCT if spec.metric == "ip" else DistanceStrategy.EUCLIDEAN_DISTANCE
+            ),
+        )
+    return converted, {**asdict(spec), "factory": factory}
+
+def load_index_config(index_dir: str) -> dict:
+    path = Path(index_dir) / INDEX_CONFIG_NAME
+    if not path.exists():
+        return {"index_type": "flat", "metric": "l2", "factory": "Flat"}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def set_search_params(index: faiss.Index, nprobe: int = None, ef_search: int = None) -> None:
+    """
+    Set query-time accuracy/speed knobs; ignored by index types that lack them.
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if nprobe and ivf is not None:
+        ivf.nprobe = nprobe
+    if ef_search and hasattr(index, "hnsw"):
+        index.hnsw.efSearch = ef_search
+
+def search_batch(vectorstore: FAISS, vectors: np.ndarray, k: int) -> List[List[Document]]:
+    """
+    Top-k documents for many query vectors with one faiss search call
+    (same normalization as `similarity_search_by_vector`).
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vectorstore._normalize_L2:
+        faiss.normalize_L2(vectors)
+    _, rows = vectorstore.index.search(vectors, k)
+    results = []
+    for row_ids in rows:
+        docs = []
+        for i in row_ids:
+            if i == -1:  # 結果不足 k 筆
+                continue
+            doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[int(i)])
+            if isinstance(doc, Document):
+                docs.append(doc)
+        results.append(docs)
+    return results
+
+def load_index(
+    index_dir: str,
+    embeddings: Embeddings,
+    nprobe: int = None,
+    ef_search: int = None,
+    use_mmap: bool = False,
+    writable: bool = False,
+) -> FAISS:
+    """
+    Load an index saved by this module, restoring its metric and search parameters.
+
+    Documents are read lazily from docs.jsonl (see `doc_store.LazyDocStore`):
+    only the hits of a search are decoded, and nothing is unpickled. With
+    `use_mmap`, the faiss index itself is memory-mapped read-only as well, so
+    load time and per-process memory do not grow with the index.
+
+    `writable` loads everything into memory instead, for updating the index.
+    Indexes saved before docs.jsonl existed are loaded from index.pkl.
+    """
+    ip = load_index_config(index_dir).get("metric") == "ip"
+    distance_strategy = DistanceStrategy.MAX_INNER_PRODUCT if ip else DistanceStrategy.EUCLIDEAN_DISTANCE
+
+    with _cosine_warning_ignored():
+        if not doc_store.has_doc_store(index_dir):
+            print(f"[!] {index_dir} uses the pickled docstore; migrate it with build_faiss_idx.py --migrate")
+            vectorstore = FAISS.load_local(
+                str(index_dir),
+                embeddings,
+                allow_dangerous_deserialization=True,  # legacy index.pkl only
+                normalize_L2=ip,
+                distance_strategy=distance_strategy,
+            )
+        else:
+            ids = doc_store.load_ids(index_dir)
+            if writable:
+                docstore = doc_store.load_docstore(index_dir, ids)
+            else:
+                docstore = doc_store.LazyDocStore(index_dir, ids)
+            flags = MMAP_FLAGS if use_mmap and not writable else 0
+            vectorstore = FAISS(
+                embedding_function=embeddings,
+                index=faiss.read_index(str(Path(index_dir) / "index.faiss"), flags),
+                docstore=docstore,
+                index_to_docstore_id=dict(enumerate(ids)),
+                normalize_L2=ip,
+                distance_strategy=distance_strategy,
+            )
+    set_search_params(vectorstore.index, nprobe, ef_search)
+    return vectorstore
+
+def migrate_index(index_dir: str, embeddings: Embeddings) -> FAISS:
+    """
+    Rewrite an index with a pickled docstore (index.pkl) in the current format.
+    """
+    vectorstore = load_index(index_dir, embeddings, writable=True)
+    index_config = load_index_config(index_dir) if (Path(index_dir) / INDEX_CONFIG_NAME).exists() else None
+    manifest = load_manifest(index_dir) or None
+    save_index_atomic(vectorstore, index_dir, manifest, index_config)
+    print(f"[✓] Migrated {index_dir}: {len(vectorstore.index_to_docstore_id)} documents")
+    return vectorstore
+
+def build_new_index(
+    chunks: Iterable[Tuple[Document, str]],
+    index_dir: str,
+    embedding_model: Embeddings,
+    batch_size: int = 32,
+    n_workers: int = 1,
+    dedup_threshold: float = None,
+    index_spec: IndexSpec = None,
+) -> FAISS:
     """
-    Build a FAISS index from Documents and save it into a directory.
+    Build a FAISS index from a stream of chunks and save it into a directory.
 
     Args:
-        docs: List of LangChain Documents to index.
+        chunks: (chunk, id) pairs, e.g. from `iter_chunks`; consumed lazily.
         index_dir: Directory path where the FAISS index will be saved.
         embedding_model: Embedding model implementing the `Embeddings` interface.
+        batch_size: Encode batch size.
+        n_workers: Number of CPU encode processes.
+        dedup_threshold: Cosine threshold for merging near-duplicate chunks (None = no dedup).
+        index_spec: FAISS index type (None = exact flat L2).
 
     Returns:
         FAISS vectorstore object
     """
-    if not docs:
-        raise ValueError("No documents provided; abort building index.")
-
     index_path = Path(index_dir)
-    index_path.mkdir(parents=True, exist_ok=True)
 
-    # Create FAISS index from documents
-    vectorstore = FAISS.from_documents(docs, embedding_model)
+    # Create FAISS index from chunks
+    vectorstore = from_chunks_batched(chunks, embedding_model, batch_size, n_workers, dedup_threshold)
+    index_config = None
+    if index_spec is not None and not index_spec.is_default():
+        vectorstore, index_config = convert_index(vectorstore, index_spec)
 
-    # Save the index to disk (writes multiple files under index_dir)
-    vectorstore.save_local(str(index_path))
+    # Save the index to disk (writes multiple files under index_dir + version.json)
+    save_index_atomic(vectorstore, index_dir, index_config=index_config)
     print(f"[✓] New index built and saved to {index_path.resolve()}")
     return vectorstore
 
+
+def _shard_paths(shard_dir: Path, shard_no: int) -> Tuple[Path, Path, Path]:
+    name = f"shard_{shard_no:05d}"
+    return shard_dir / f"{name}.npy", shard_dir / f"{name}.jsonl", shard_dir / f"{name}.done"
+
+def _shard_digest(ids: List[str], texts: List[str]) -> str:
+    h = hashlib.sha256()
+    for chunk_id, text in zip(ids, texts):
+        h.update(chunk_id.encode("utf-8"))
+        h.update(b"\0")
+        h.update(text.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+def drop_exact_duplicates(
+    chunks: Iterable[Tuple[Document, str]],
+    duplicates: Dict[str, List[dict]],
+) -> Iterator[Tuple[Document, str]]:
+    """
+    Yield only the first chunk of every whitespace-normalized text, so exact
+    duplicates are never embedded; the metadata of the dropped copies is
+    collected in `duplicates` ({kept chunk id: [metadata, ...]}).
+    """
+    first: Dict[str, str] = {}
+    for chunk, chunk_id in chunks:
+        h = content_hash(" ".join(chunk.page_content.split()))
+        if h in first:
+            duplicates.setdefault(first[h], []).append(chunk.metadata)
+            continue
+        first[h] = chunk_id
+        yield chunk, chunk_id
+
+def embed_to_shards(
+    chunks: Iterable[Tuple[Document, str]],
+    shard_dir: str,
+    embedding_model: Embeddings,
+    shard_size: int = 4096,
+    batch_size: int = 32,
+    n_workers: int = 1,
+) -> int:
+    """
+    Embed (chunk, id) pairs shard by shard and persist every shard to disk.
+
+    Each shard writes its vectors (.npy), texts/metadata (.jsonl) and finally a
+    .done marker holding a digest of its ids and texts. On restart, shards whose
+    marker matches the current content are skipped, so an interrupted build
+    resumes from the last completed shard.
+
+    Returns:
+        Number of shards.
+    """
+    shard_path = Path(shard_dir)
+    shard_path.mkdir(parents=True, exist_ok=True)
+    chunks = iter(chunks)
+
+    n_shards = 0
+    while True:
+        shard = list(itertools.islice(chunks, shard_size))
+        if not shard:
+            break
+        shard_no = n_shards
+        n_shards += 1
+
+        docs = [doc for doc, _ in shard]
+        ids = [chunk_id for _, chunk_id in shard]
+        texts = [doc.page_content for doc in docs]
+        digest = _shard_digest(ids, texts)
+        vec_path, meta_path, done_path = _shard_paths(shard_path, shard_no)
+        if done_path.exists() and done_path.read_text() == digest:
+            print(f"[=] Shard {shard_no} already embedded, skipped")
+            continue
+
+        vectors = embed_texts(texts, embedding_model, batch_size=batch_size, n_workers=n_workers)
+        with open(str(vec_path) + ".tmp", "wb") as f:
+            np.save(f, np.asarray(vectors, dtype=np.float32))
+        with open(str(meta_path) + ".tmp", "w", encoding="utf-8") as f:
+            for doc, chunk_id in zip(docs, ids):
+                f.write(json.dumps(
+                    {"id": chunk_id, "page_content": doc.page_content, "metadata": doc.metadata},
+                    ensure_ascii=False,
+                ) + "\n")
+        os.replace(str(vec_path) + ".tmp", vec_path)
+        os.replace(str(meta_path) + ".tmp", meta_path)
+        # .done 最後寫入：有 .done 才代表這個 shard 完整
+        done_path.write_text(digest)
+        print(f"[+] Shard {shard_no} saved ({len(shard)} chunks)")
+
+    return n_shards
+
+def merge_shards(
+    shard_dir: str,
+    n_shards: int,
+    embedding_model: Embeddings,
+    dedup_threshold: float = None,
+    duplicates: Dict[str, List[dict]] = None,
+) -> FAISS:
+    """
+    Build one FAISS vectorstore from the shards written by `embed_to_shards`.
+    With `dedup_threshold`, duplicates are merged across all shards, together
+    with the exact `duplicates` dropped before embedding.
+    """
+    shard_path = Path(shard_dir)
+    dedup = ChunkDeduplicator(dedup_threshold) if dedup_threshold is not None else None
+    vectorstore = None
+    for shard_no in range(n_shards):
+        vec_path, meta_path, _ = _shard_paths(shard_path, shard_no)
+        vectors = np.load(vec_path)
+        with open(meta_path, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+
+        text_embeddings = [(r["page_content"], vec) for r, vec in zip(records, vectors.tolist())]
+        metadatas = [r["metadata"] for r in records]
+        ids = [r["id"] for r in records]
+        if dedup is not None:
+            for (text, vec), metadata, chunk_id in zip(text_embeddings, metadatas, ids):
+                dedup.add(text, vec, metadata, chunk_id)
+                if duplicates and chunk_id in duplicates:
+                    dedup.merge_exact(text, duplicates[chunk_id])
+            continue
+        if vectorstore is None:
+            vectorstore = FAISS.from_embeddings(text_embeddings, embedding_model, metadatas=metadatas, ids=ids)
+        else:
+            vectorstore.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+
+    if dedup is not None:
+        return dedup.to_vectorstore(embedding_model)
+    if vectorstore is None:
+        raise ValueError("No documents provided; abort building index.")
+    return vectorstore
+
+def build_new_index_sharded(
+    chunks: Iterable[Tuple[Document, str]],
+    index_dir: str,
+    embedding_model: Embeddings,
+    shard_size: int = 4096,
+    batch_size: int = 32,
+    n_workers: int = 1,
+    keep_shards: bool = False,
+    dedup_threshold: float = None,
+    index_spec: IndexSpec = None,
+) -> FAISS:
+    """
+    Resumable version of `build_new_index`.
+
+    Shards are checkpointed under "<index_dir>.shards"; re-running the same
+    build after a crash only embeds the missing shards, then merges all shards
+    into the final index.
+
+    Args:
+        chunks: (chunk, id) pairs, e.g. zip(*split_with_ids(docs)).
+        index_dir: Directory path where the FAISS index will be saved.
+        embedding_model: Embedding model implementing the `Embeddings` interface.
+        shard_size: Number of chunks per checkpoint.
+        batch_size: Encode batch size.
+        n_workers: Number of CPU encode processes.
+        keep_shards: Keep the shard directory after a successful build.
+        dedup_threshold: Cosine threshold for merging near-duplicate chunks (None = no dedup).
+        index_spec: FAISS index type (None = exact flat L2).
+
+    Returns:
+        FAISS vectorstore object
+    """
+    index_path = Path(index_dir)
+    shard_dir = index_path.with_name(index_path.name + ".shards")
+
+    duplicates: Dict[str, List[dict]] = {}
+    if dedup_threshold is not None:
+        # 完全相同的文字在 embedding 前就去掉；near-duplicate 在合併 shard 時處理
+        chunks = drop_exact_duplicates(chunks, duplicates)
+    n_shards = embed_to_shards(chunks, shard_dir, embedding_model, shard_size, batch_size, n_workers)
+    vectorstore = merge_shards(shard_dir, n_shards, embedding_model, dedup_threshold, duplicates)
+    index_config = None
+    if index_spec is not None and not index_spec.is_default():
+        vectorstore, index_config = convert_index(vectorstore, index_spec)
+    save_index_atomic(vectorstore, index_dir, index_config=index_config)
+    if not keep_shards:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    print(f"[✓] New index built from {n_shards} shards and saved to {index_path.resolve()}")
+    return vectorstore
+
+def get_index_version(index_dir: str) -> str:
+    """
+    Identify the index currently on disk; changes whenever the index is rebuilt.
+    """
+    version_path = Path(index_dir) / VERSION_NAME
+    if version_path.exists():
+        with open(version_path, "r", encoding="utf-8") as f:
+            return json.load(f)["version"]
+    # 舊版 index 沒有 version.json
+    stat = os.stat(Path(index_dir) / "index.faiss")
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def load_manifest(index_dir: str) -> Dict[str, dict]:
+    """
+    Manifest of an incrementally built index: {file path: {"hash": ..., "chunks": {chunk id: content hash}}}
+    """
+    path = Path(index_dir) / MANIFEST_NAME
+    if not path.exists():
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_index_atomic(
+    vectorstore: FAISS,
+    index_dir: str,
+    manifest: Dict[str, dict] = None,
+    index_config: dict = None,
+) -> None:
+    """
+    Write the faiss index, its docs.jsonl docstore, manifest, index config and
+    a new version.json into a temp directory,
+    then swap it in place, so readers never see a half-written index.
+    Serving processes watch version.json to hot-reload the index.
+    """
+    index_path = Path(index_dir)
+    tmp_path = index_path.with_name(index_path.name + ".tmp")
+    old_path = index_path.with_name(index_path.name + ".old")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    shutil.rmtree(old_path, ignore_errors=True)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path.mkdir(parents=True)
+    faiss.write_index(vectorstore.index, str(tmp_path / "index.faiss"))
+    doc_store.write_doc_store(vectorstore.docstore, vectorstore.index_to_docstore_id, tmp_path)
+    if manifest is not None:
+        with open(tmp_path / MANIFEST_NAME, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+    if index_config is not None:
+        with open(tmp_path / INDEX_CONFIG_NAME, "w", encoding="utf-8") as f:
+            json.dump(index_config, f, indent=2)
+    with open(tmp_path / VERSION_NAME, "w", encoding="utf-8") as f:
+        json.dump({
+            "version": uuid.uuid4().hex,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "n_vectors": len(vectorstore.index_to_docstore_id),
+        }, f, indent=2)
+
+    if index_path.exists():
+        os.rename(index_path, old_path)
+    os.rename(tmp_path, index_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+def update_index(
+    files: Iterable[str],
+    index_dir: str,
+    embedding_model: Embeddings,
+    chunk_size: int = 512,
+    batch_size: int = 32,
+    n_workers: int = 1,
+    index_spec: IndexSpec = None,
+) -> FAISS:
+    """
+    Incrementally update a FAISS index from `files`.
+
+    Only files whose content hash changed are re-loaded and re-split; within
+    them, only chunks whose id or content changed are embedded. Chunks of
+    removed or edited files are deleted from the docstore and the index.
+
+    Args:
+        files: All files that should be in the index.
+        index_dir: Directory of the index (created on the first run).
+        embedding_model: Embedding model implementing the `Embeddings` interface.
+        chunk_size: Chunk size passed to the text splitter.
+        batch_size: Encode batch size.
+        n_workers: Number of CPU encode processes.
+        index_spec: FAISS index used when the index is built from scratch
+            (None = exact flat L2); an existing index keeps its own metric.
+            Only flat indexes are supported: HNSW cannot delete vectors, and
+            IVF / PQ keep the original labels on delete, which breaks the
+            row -> docstore id mapping that LangChain compacts.
+
+    Returns:
+        FAISS vectorstore object
+    """
+    if index_spec is not None and index_spec.index_type != "flat":
+        raise ValueError(
+            f"Incremental updates only support flat indexes, not {index_spec.index_type}; "
+            "build approximate indexes without incremental updates"
+        )
+    index_path = Path(index_dir)
+    manifest = load_manifest(index_dir)
+    vectorstore = None
+    index_config = None
+    if manifest and (index_path / "index.faiss").exists():
+        if (index_path / INDEX_CONFIG_NAME).exists():
+            index_config = load_index_config(str(index_path))
+            if index_config.get("index_type", "flat") != "flat":
+                raise ValueError(
+                    f"{index_path} is a {index_config['index_type']} index; "
+                    "incremental updates only support flat indexes"
+                )
+        if index_spec is not None and (index_config or {}).get("metric", "l2") != index_spec.metric:
+            print(f"[!] {index_path} keeps its existing metric; rebuild without incremental updates to change it")
+        vectorstore = load_index(str(index_path), embedding_model, writable=True)
+    elif (index_path / "index.faiss").exists():
+        print(f"[!] {index_path} has no {MANIFEST_NAME}; rebuilding it from scratch")
+        manifest = {}
+
+    files = [str(f) for f in files]
+    new_manifest: Dict[str, dict] = {}
+    to_delete: List[str] = []
+    new_chunks: List[Document] = []
+    new_ids: List[str] = []
+
+    for path in files:
+        digest = file_hash(path)
+        old = manifest.get(path)
+        if old is not None and old["hash"] == digest:
+            new_manifest[path] = old
+            continue
+
+        chunks, ids = split_with_ids(load_file(path), chunk_size=chunk_size)
+        old_chunks = old["chunks"] if old is not None else {}
+        file_chunks = {}
+        for chunk, chunk_id in zip(chunks, ids):
+            h = content_hash(chunk.page_content)
+            file_chunks[chunk_id] = h
+            if old_chunks.get(chunk_id) != h:
+                if chunk_id in old_chunks:
+                    to_delete.append(chunk_id)
+                new_chunks.append(chunk)
+                new_ids.append(chunk_id)
+        to_delete.extend(i for i in old_chunks if i not in file_chunks)
+        new_manifest[path] = {"hash": digest, "chunks": file_chunks}
+
+    # 已刪除的檔案
+    for path, old in manifest.items():
+        if path not in new_manifest:
+            to_delete.extend(old["chunks"])
+
+    if vectorstore is not None and to_delete:
+        vectorstore.delete(to_delete)
+    if new_chunks:
+        if vectorstore is None:
+            vectorstore = from_documents_batched(new_chunks, embedding_model, new_ids, batch_size, n_workers)
+            # 第一次建立 (或沒有 manifest 而重建) 時套用指定的 index 類型
+            if index_spec is not None and not index_spec.is_default():
+                vectorstore, index_config = convert_index(vectorstore, index_spec)
+        else:
+            texts = [c.page_content for c in new_chunks]
+            vectors = embed_texts(texts, embedding_model, batch_size=batch_size, n_workers=n_workers)
+            vectorstore.add_embeddings(
+                list(zip(texts, vectors)),
+                metadatas=[c.metadata for c in new_chunks],
+                ids=new_ids,
+            )
+    if vectorstore is None:
+        raise ValueError("No documents provided; abort building index.")
+    # flat index 刪除後會重新編號，row 數必須與 docstore id 對應一致
+    if vectorstore.index.ntotal != len(vectorstore.index_to_docstore_id):
+        raise RuntimeError(
+            f"Index has {vectorstore.index.ntotal} vectors but {len(vectorstore.index_to_docstore_id)} docstore ids"
+        )
+
+    save_index_atomic(vectorstore, index_dir, new_manifest, index_config)
+    print(
+        f"[✓] Index updated at {index_path.resolve()}: "
+        f"+{len(new_chunks)} / -{len(to_delete)} chunks, {len(vectorstore.index_to_docstore_id)} total"
+    )
+    return vectorstore
@@ -0,0 +1,75 @@
+import time
+import threading
+from typing import List, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from . import tracing
+
+
+class CrossEncoderReranker:
+    """
+    Local cross-encoder (e.g. BAAI/bge-reranker-base) scoring (query, chunk) pairs on CPU.
+    """
+
+    def __init__(self, model_name: str, batch_size: int = 16, max_length: int = 512, device: str = "cpu"):
+        from sentence_transformers import CrossEncoder
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = CrossEncoder(model_name, max_length=max_length, device=device)
+        # CrossEncoder.predict 不保證 thread-safe
+        self._lock = threading.Lock()
+
+    def score(self, query: str, docs: List[Document], deadline: float = None) -> Optional[List[float]]:
+        """
+        Score `docs` batch by batch. Returns None as soon as `deadline`
+        (a time.perf_counter() value) has passed.
+        """
+        scores: List[float] = []
+        with self._lock:
+            for start in range(0, len(docs), self.batch_size):
+                if deadline is not None and time.perf_counter() > deadline:
+                    return None
+                pairs = [(query, d.page_content) for d in docs[start:start + self.batch_size]]
+                scores.extend(float(s) for s in self.model.predict(pairs, batch_size=self.batch_size))
+        if deadline is not None and time.perf_counter() > deadline:
+            return None
+        return scores
+
+
+class RerankRetriever(BaseRetriever):
+    """
+    Rerank the candidates of `base` (retrieved with a wider k) with a cross-encoder
+    and keep the best `k`.
+
+    If scoring does not finish within `budget_ms`, the candidates are returned
+    in their original (dense / hybrid) order instead.
+    """
+
+    base: BaseRetriever
+    reranker: CrossEncoderReranker
+    k: int = 5
+    budget_ms: float = 300.0
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        candidates = self.base.invoke(query, config={"callbacks": run_manager.get_child()})
+        if len(candidates) <= 1:
+            return candidates[: self.k]
+
+        start = time.perf_counter()
+        deadline = start + self.budget_ms / 1000 if self.budget_ms > 0 else None
+        with tracing.span("rerank"):
+            scores = self.reranker.score(query, candidates, deadline)
+        if scores is None:
+            print(f"[Rerank] Budget of {self.budget_ms:.0f} ms exceeded, kept retrieval order")
+            return candidates[: self.k]
+
+        ranked = sorted(zip(scores, range(len(candidates))), key=lambda x: x[0], reverse=True)
+        return [candidates[i] for _, i in ranked[: self.k]]
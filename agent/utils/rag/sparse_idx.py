@@ -0,0 +1,150 @@
+import os
+import re
+import json
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Tuple
+
+from langchain_community.retrievers import BM25Retriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+try:
+    import jieba
+    jieba.setLogLevel(60)
+except ImportError:
+    jieba = None
+
+CHUNKS_NAME = "chunks.jsonl"
+META_NAME = "meta.json"
+VERSION_NAME = "version.json"  # 每次重建都會改變；serving process 據此熱更新
+
+_CJK_RUN = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]+")
+_WORD = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]+|[A-Za-z0-9]+")
+
+
+def tokenize_zh(text: str) -> List[str]:
+    """
+    Chinese-aware tokenizer for BM25.
+
+    Uses jieba's search-mode segmentation when installed; otherwise falls back
+    to character unigrams + bigrams for CJK runs and lowercase words for the rest.
+    """
+    if jieba is not None:
+        return [t.lower() for t in jieba.lcut_for_search(text) if t.strip()]
+
+    tokens = []
+    for run in _WORD.findall(text):
+        if _CJK_RUN.fullmatch(run):
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run.lower())
+    return tokens
+
+
+def build_sparse_index(chunks: Iterable[Tuple[Document, str]], index_dir: str) -> None:
+    """
+    Tokenize chunks and save them (with ids and metadata) as JSON lines.
+
+    Chunks are written one at a time, so the build does not hold the corpus in
+    memory. Files are written to temp names and swapped in, then version.json
+    is rewritten so serving processes reload the index.
+
+    Args:
+        chunks: (chunk, id) pairs from the same loader/splitter as the FAISS
+            index (`process_faiss_idx.iter_chunks`).
+        index_dir: Output directory.
+    """
+    index_path = Path(index_dir)
+    index_path.mkdir(parents=True, exist_ok=True)
+    n_chunks = 0
+    with open(index_path / (CHUNKS_NAME + ".tmp"), "w", encoding="utf-8") as f:
+        for chunk, chunk_id in chunks:
+            record = {
+                "id": chunk_id,
+                "page_content": chunk.page_content,
+                "metadata": chunk.metadata,
+                "tokens": tokenize_zh(chunk.page_content),
+            }
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            n_chunks += 1
+    if n_chunks == 0:
+        os.remove(index_path / (CHUNKS_NAME + ".tmp"))
+        raise ValueError("No documents provided; abort building sparse index.")
+    with open(index_path / (META_NAME + ".tmp"), "w", encoding="utf-8") as f:
+        json.dump({"tokenizer": "jieba" if jieba is not None else "char_bigram", "n_chunks": n_chunks}, f)
+    with open(index_path / (VERSION_NAME + ".tmp"), "w", encoding="utf-8") as f:
+        json.dump({"version": uuid.uuid4().hex, "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")}, f, indent=2)
+    for name in (CHUNKS_NAME, META_NAME, VERSION_NAME):
+        os.replace(index_path / (name + ".tmp"), index_path / name)
+    print(f"[✓] Sparse index with {n_chunks} chunks saved to {index_path.resolve()}")
+
+
+def get_sparse_index_version(index_dir: str) -> str:
+    """
+    Identify the sparse index currently on disk; changes whenever it is rebuilt.
+    """
+    version_path = Path(index_dir) / VERSION_NAME
+    if version_path.exists():
+        with open(version_path, "r", encoding="utf-8") as f:
+            return json.load(f)["version"]
+    # 舊版 sparse index 沒有 version.json
+    stat = os.stat(Path(index_dir) / CHUNKS_NAME)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def load_sparse_retriever(index_dir: str, k: int) -> BaseRetriever:
+    """
+    Load a BM25 retriever from a directory written by `build_sparse_index`.
+    """
+    from rank_bm25 import BM25Okapi
+
+    docs, corpus = [], []
+    with open(Path(index_dir) / CHUNKS_NAME, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            docs.append(Document(id=record["id"], page_content=record["page_content"], metadata=record["metadata"]))
+            corpus.append(record["tokens"])
+
+    return BM25Retriever(vectorizer=BM25Okapi(corpus), docs=docs, k=k, preprocess_func=tokenize_zh)
+
+
+def _doc_key(doc: Document) -> tuple:
+    # dense 與 sparse 的同一個 chunk：相同 uuid 與內容
+    return (doc.metadata.get("uuid"), doc.page_content)
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuse dense (FAISS) and sparse (BM25) results with weighted reciprocal-rank fusion:
+    score(d) = sum_i w_i / (rrf_c + rank_i(d)).
+    """
+
+    dense: BaseRetriever
+    sparse: BaseRetriever
+    k: int = 5
+    dense_weight: float = 0.5
+    rrf_c: int = 60
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        callbacks = run_manager.get_child()
+        ranked_lists = [
+            (self.dense_weight, self.dense.invoke(query, config={"callbacks": callbacks})),
+            (1.0 - self.dense_weight, self.sparse.invoke(query, config={"callbacks": callbacks})),
+        ]
+
+        scores: Dict[tuple, float] = {}
+        docs: Dict[tuple, Any] = {}
+        for weight, ranked in ranked_lists:
+            for rank, doc in enumerate(ranked, start=1):
+                key = _doc_key(doc)
+                scores[key] = scores.get(key, 0.0) + weight / (self.rrf_c + rank)
+                docs.setdefault(key, doc)
+
+        best = sorted(scores, key=scores.get, reverse=True)[: self.k]
+        return [docs[key] for key in best]
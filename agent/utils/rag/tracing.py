@@ -0,0 +1,370 @@
+"""
+Per-request latency tracing for the chatbot.
+
+A request (`with request("chat"):`) collects the duration of every stage run
+inside it: our own code is wrapped in `span(stage)`, LangChain runs are timed
+by `StageTimingHandler` (passed as a callback). Stage durations also feed
+process-wide histograms.
+
+Exports:
+    - JSONL: one line per finished request (`configure(jsonl_path=...)`)
+    - Prometheus text format on http://<host>:<port>/metrics (`start_metrics_server`)
+
+`python -m utils.rag.tracing <traces.jsonl>` prints p50 / p95 per stage.
+"""
+import os
+import json
+import time
+import uuid
+import argparse
+import threading
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+# 秒；涵蓋 query embedding (ms 等級) 到 LLM 生成 (數十秒)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# LangChain run 名稱 -> stage
+RUN_STAGES = {
+    "ChatPromptTemplate": "prompt_build",
+    "format_docs": "context_pack",
+    "format_docs_with_budget": "context_pack",
+    "BM25Retriever": "bm25_search",
+    "question_condenser": "question_condense",
+}
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最後一格為 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Process-wide stage histograms and token / request counters.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages: Dict[str, Histogram] = {}
+        self.requests: Dict[tuple, Histogram] = {}  # {(name, status): Histogram}
+        self.tokens: Dict[str, int] = {"prompt": 0, "completion": 0}
+
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stages.setdefault(stage, Histogram()).observe(seconds)
+
+    def observe_request(self, name: str, status: str, seconds: float) -> None:
+        with self._lock:
+            self.requests.setdefault((name, status), Histogram()).observe(seconds)
+
+    def add_tokens(self, prompt: int, completion: int) -> None:
+        with self._lock:
+            self.tokens["prompt"] += prompt
+            self.tokens["completion"] += completion
+
+    def render_prometheus(self) -> str:
+        lines = []
+
+        def histogram(metric: str, labels: str, hist: Histogram) -> None:
+            cumulative = 0
+            for bound, count in zip([str(b) for b in hist.buckets] + ["+Inf"], hist.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_sum{{{labels}}} {hist.sum}")
+            lines.append(f"{metric}_count{{{labels}}} {hist.count}")
+
+        with self._lock:
+            lines.append("# HELP rag_stage_duration_seconds Duration of each request stage.")
+            lines.append("# TYPE rag_stage_duration_seconds histogram")
+            for stage, hist in sorted(self.stages.items()):
+                histogram("rag_stage_duration_seconds", f'stage="{stage}"', hist)
+            lines.append("# HELP rag_request_duration_seconds End-to-end request duration.")
+            lines.append("# TYPE rag_request_duration_seconds histogram")
+            for (name, status), hist in sorted(self.requests.items()):
+                histogram("rag_request_duration_seconds", f'name="{name}",status="{status}"', hist)
+            lines.append("# HELP rag_llm_tokens_total LLM tokens used.")
+            lines.append("# TYPE rag_llm_tokens_total counter")
+            for kind, n in self.tokens.items():
+                lines.append(f'rag_llm_tokens_total{{type="{kind}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+
+class RequestTrace:
+    """
+    Stage durations (ms, summed when a stage runs several times) and token counts of one request.
+    """
+
+    def __init__(self, name: str, **attrs):
+        self.request_id = uuid.uuid4().hex
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.stages: Dict[str, float] = {}
+        self.tokens = {"prompt": 0, "completion": 0}
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds * 1000
+
+    def add_tokens(self, prompt: int, completion: int) -> None:
+        with self._lock:
+            self.tokens["prompt"] += prompt
+            self.tokens["completion"] += completion
+
+    def callback(self) -> "StageTimingHandler":
+        return StageTimingHandler(self)
+
+    def to_dict(self, total_s: float, status: str) -> dict:
+        with self._lock:
+            return {
+                "request_id": self.request_id,
+                "name": self.name,
+                "started_at": self.started_at,
+                "status": status,
+                "total_ms": total_s * 1000,
+                "stages_ms": dict(self.stages),
+                "tokens": dict(self.tokens),
+                **self.attrs,
+            }
+
+
+metrics = Metrics()
+_current: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar("rag_request_trace", default=None)
+_config = {"jsonl_path": os.getenv("TRACE_JSONL_PATH") or None}
+_jsonl_lock = threading.Lock()
+
+
+def configure(jsonl_path: str = None) -> None:
+    """
+    Write finished requests to `jsonl_path` (None: histograms only).
+    """
+    _config["jsonl_path"] = jsonl_path
+    if jsonl_path:
+        os.makedirs(os.path.dirname(os.path.abspath(jsonl_path)), exist_ok=True)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current.get()
+
+
+def record(stage: str, seconds: float) -> None:
+    metrics.observe_stage(stage, seconds)
+    trace = _current.get()
+    if trace is not None:
+        trace.add_stage(stage, seconds)
+
+
+@contextmanager
+def span(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def traced(stage: str):
+    """
+    Decorator form of `span`.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def request(name: str = "chat", **attrs):
+    """
+    Trace one request; yields its `RequestTrace` (pass `trace.callback()` to the chain).
+    """
+    trace = RequestTrace(name, **attrs)
+    token = _current.set(trace)
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield trace
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        _current.reset(token)
+        total = time.perf_counter() - start
+        metrics.observe_request(name, status, total)
+        if _config["jsonl_path"]:
+            line = json.dumps(trace.to_dict(total, status), ensure_ascii=False)
+            with _jsonl_lock:
+                with open(_config["jsonl_path"], "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+
+
+def _token_usage(response: LLMResult) -> tuple:
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+
+
+class StageTimingHandler(BaseCallbackHandler):
+    """
+    Time LangChain runs of one request: the outermost retriever ("retrieval"),
+    runs listed in RUN_STAGES, and LLM calls ("llm", "llm_ttft" when streaming,
+    plus token usage).
+    """
+
+    def __init__(self, trace: RequestTrace):
+        self.trace = trace
+        self._runs: Dict[UUID, tuple] = {}  # {run_id: (stage, start)}
+        self._retrievers = set()
+        self._first_token = set()
+        self._lock = threading.Lock()
+
+    def _start(self, run_id: UUID, stage: Optional[str]) -> None:
+        if stage is not None:
+            with self._lock:
+                self._runs[run_id] = (stage, time.perf_counter())
+
+    def _end(self, run_id: UUID) -> None:
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is not None:
+            stage, start = run
+            seconds = time.perf_counter() - start
+            metrics.observe_stage(stage, seconds)
+            self.trace.add_stage(stage, seconds)
+
+    @staticmethod
+    def _run_name(serialized: Optional[dict], kwargs: dict) -> Optional[str]:
+        return kwargs.get("name") or (serialized or {}).get("name")
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs) -> None:
+        self._start(run_id, RUN_STAGES.get(self._run_name(serialized, kwargs)))
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs) -> None:
+        with self._lock:
+            self._retrievers.add(run_id)
+            nested = parent_run_id in self._retrievers
+        stage = RUN_STAGES.get(self._run_name(serialized, kwargs))
+        self._start(run_id, stage if nested else "retrieval")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        self._start(run_id, "llm")
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs) -> None:
+        self._start(run_id, "llm")
+
+    def on_llm_new_token(self, token: str, *, run_id, **kwargs) -> None:
+        with self._lock:
+            if run_id in self._first_token or run_id not in self._runs:
+                return
+            self._first_token.add(run_id)
+            _, start = self._runs[run_id]
+        seconds = time.perf_counter() - start
+        metrics.observe_stage("llm_ttft", seconds)
+        self.trace.add_stage("llm_ttft", seconds)
+
+    def on_llm_end(self, response: LLMResult, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+        prompt, completion = _token_usage(response)
+        metrics.add_tokens(prompt, completion)
+        self.trace.add_tokens(prompt, completion)
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> None:
+    """
+    Serve `metrics` in Prometheus text format on http://host:port/metrics (daemon thread).
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            data = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[Tracing] Metrics on http://{host}:{port}/metrics")
+
+
+def summarize(jsonl_path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    p50 / p95 / mean (ms) of every stage over the requests in a JSONL trace file.
+    """
+    import numpy as np
+
+    values: Dict[str, List[float]] = {}
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            values.setdefault("total", []).append(record["total_ms"])
+            for stage, ms in record["stages_ms"].items():
+                values.setdefault(stage, []).append(ms)
+    return {
+        stage: {
+            "n": len(v),
+            "p50_ms": float(np.percentile(v, 50)),
+            "p95_ms": float(np.percentile(v, 95)),
+            "mean_ms": float(np.mean(v)),
+        }
+        for stage, v in values.items()
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize per-stage latency from a trace JSONL file")
+    parser.add_argument("jsonl_path", type=str)
+    args = parser.parse_args()
+    for stage, stats in sorted(summarize(args.jsonl_path).items(), key=lambda x: -x[1]["mean_ms"]):
+        print(f"{stage:<16} n={stats['n']:<6} p50={stats['p50_ms']:9.1f} ms  p95={stats['p95_ms']:9.1f} ms  mean={stats['mean_ms']:9.1f} ms")
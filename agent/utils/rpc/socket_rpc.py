@@ -0,0 +1,200 @@
+"""
+Request/response transport between telegram_frontend.py and the backend.
+
+Newline-delimited JSON over a Unix-domain socket:
+    request : {"id": str, "text": str, "stream": bool, "session": str | null}
+    response: {"id": str, "reply": str} or {"id": str | null, "error": str}
+
+With "stream": true the server first sends zero or more {"id": str, "delta": str}
+frames, then the final response. "session" (the Telegram chat id) is passed
+to the handlers so that multi-turn chats keep separate histories.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import argparse
+import socketserver
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+DEFAULT_SOCKET_PATH = os.getenv("BACKEND_SOCKET_PATH", "/tmp/studyaboard_backend.sock")
+MAX_LINE_BYTES = 2 ** 20
+
+
+class RPCError(RuntimeError):
+    pass
+
+
+def _make_handler(
+    handle_msg: Callable[[str, Optional[str]], str],
+    stream_msg: Optional[Callable[[str, Optional[str]], Iterator[str]]],
+):
+    class _Handler(socketserver.StreamRequestHandler):
+        def send(self, frame: dict) -> None:
+            self.wfile.write((json.dumps(frame, ensure_ascii=False) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+        def handle(self):
+            # 同一條連線可以連續送多個 request
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                req_id = None
+                try:
+                    # 格式錯誤或截斷的 frame 只回錯誤，不中斷這條連線
+                    req = json.loads(line)
+                    req_id = req.get("id")
+                    if req.get("stream") and stream_msg is not None:
+                        pieces = []
+                        for delta in stream_msg(req["text"], req.get("session")):
+                            pieces.append(delta)
+                            self.send({"id": req["id"], "delta": delta})
+                        reply = "".join(pieces)
+                    else:
+                        reply = handle_msg(req["text"], req.get("session"))
+                    resp = {"id": req_id, "reply": reply}
+                except Exception as e:
+                    print(f"[RPC] Request {req_id} failed: {e!r}")
+                    resp = {"id": req_id, "error": repr(e)}
+                self.send(resp)
+
+    return _Handler
+
+
+class BackendServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(
+    handle_msg: Callable[[str, Optional[str]], str],
+    socket_path: str = DEFAULT_SOCKET_PATH,
+    stream_msg: Optional[Callable[[str, Optional[str]], Iterator[str]]] = None,
+) -> BackendServer:
+    """
+    Create a threaded Unix-socket server; every connection is served by its own thread.
+
+    Args:
+        handle_msg: Function mapping the user text and session id to the reply text.
+        socket_path: Path of the Unix-domain socket (a stale file is removed).
+        stream_msg: Optional function yielding the reply piece by piece, used for
+            requests sent with "stream": true.
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+    return BackendServer(socket_path, _make_handler(handle_msg, stream_msg))
+
+
+def _encode_request(text: str, stream: bool = False, session: str = None) -> tuple[str, bytes]:
+    req_id = uuid.uuid4().hex
+    payload = json.dumps({"id": req_id, "text": text, "stream": stream, "session": session}, ensure_ascii=False) + "\n"
+    return req_id, payload.encode("utf-8")
+
+
+def _parse_frame(line: bytes, req_id: str) -> dict:
+    if not line:
+        raise RPCError("Backend closed the connection without replying")
+    resp = json.loads(line)
+    if resp.get("id") is None and "error" in resp:
+        # server 無法解析 request (沒有 id 可回)
+        raise RPCError(resp["error"])
+    if resp.get("id") != req_id:
+        raise RPCError(f"Mismatched response id: {resp.get('id')} != {req_id}")
+    if "error" in resp:
+        raise RPCError(resp["error"])
+    return resp
+
+
+def _parse_response(line: bytes, req_id: str) -> str:
+    return _parse_frame(line, req_id)["reply"]
+
+
+def request(text: str, socket_path: str = DEFAULT_SOCKET_PATH, timeout: float = None, session: str = None) -> str:
+    """
+    Send one message to the backend and block until its reply arrives.
+    """
+    req_id, payload = _encode_request(text, session=session)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(payload)
+        with sock.makefile("rb") as f:
+            line = f.readline()
+
+    return _parse_response(line, req_id)
+
+
+async def async_request(
+    text: str,
+    socket_path: str = DEFAULT_SOCKET_PATH,
+    timeout: float = None,
+    session: str = None,
+) -> str:
+    """
+    Awaitable version of `request`: the event loop keeps serving other chats while waiting.
+    """
+    req_id, payload = _encode_request(text, session=session)
+
+    reader, writer = await asyncio.open_unix_connection(socket_path, limit=MAX_LINE_BYTES)
+    try:
+        writer.write(payload)
+        await writer.drain()
+        line = await asyncio.wait_for(reader.readline(), timeout)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+    return _parse_response(line, req_id)
+
+
+async def async_stream_request(
+    text: str,
+    socket_path: str = DEFAULT_SOCKET_PATH,
+    timeout: float = None,
+    session: str = None,
+) -> AsyncIterator[str]:
+    """
+    Send one message in streaming mode and yield the reply pieces as they arrive.
+
+    `timeout` applies to the gap between two frames, not to the whole reply.
+    """
+    req_id, payload = _encode_request(text, stream=True, session=session)
+
+    reader, writer = await asyncio.open_unix_connection(socket_path, limit=MAX_LINE_BYTES)
+    try:
+        writer.write(payload)
+        await writer.drain()
+        while True:
+            frame = _parse_frame(await asyncio.wait_for(reader.readline(), timeout), req_id)
+            if "delta" not in frame:
+                break
+            yield frame["delta"]
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+if __name__ == "__main__":
+    # 本地 stub backend：不載入模型、不呼叫 LLM，用來測試 frontend 與傳輸層
+    parser = argparse.ArgumentParser(description="Run a stub backend that echoes messages")
+    parser.add_argument("--socket_path", type=str, default=DEFAULT_SOCKET_PATH)
+    parser.add_argument("--delay", type=float, default=0.0, help="Simulated generation latency (seconds)")
+    args = parser.parse_args()
+
+    def stub_llm(text: str, session: str = None) -> str:
+        time.sleep(args.delay)
+        if text.startswith("/"):
+            return "Success"
+        return f"(stub) {text}"
+
+    def stub_stream(text: str, session: str = None) -> Iterator[str]:
+        reply = stub_llm(text, session)
+        for i in range(0, len(reply), 4):
+            yield reply[i:i + 4]
+
+    with create_server(stub_llm, args.socket_path, stream_msg=stub_stream) as server:
+        print(f"Stub backend listening on {args.socket_path}")
+        server.serve_forever()
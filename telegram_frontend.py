@@ -1,4 +1,7 @@
 import os
+import time
+import asyncio
+import weakref
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -11,35 +14,61 @@ from telegram.ext import (
     ContextTypes,
 )
 
+from agent.utils.rag import tracing
+from agent.utils.rpc.socket_rpc import DEFAULT_SOCKET_PATH, async_request, async_stream_request
+
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# 同時送往後端的請求上限
+MAX_CONCURRENCY = int(os.getenv("BACKEND_MAX_CONCURRENCY", "8"))
+# 串流回覆：邊生成邊編輯訊息，兩次編輯至少間隔 STREAM_EDIT_INTERVAL 秒 (避免 Telegram rate limit)
+STREAM_REPLY = os.getenv("STREAM_REPLY", "true").lower() in ["true", "1", "yes"]
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+# 每則訊息的耗時 (等待後端、Telegram 傳送)：TRACE_JSONL_PATH 寫入 JSONL，FRONTEND_METRICS_PORT 提供 Prometheus metrics
+FRONTEND_METRICS_PORT = int(os.getenv("FRONTEND_METRICS_PORT", "0"))
+
+backend_slots = asyncio.Semaphore(MAX_CONCURRENCY)
+# 同一個 chat 的訊息依序處理，不同 chat 之間可以並行
+chat_locks = weakref.WeakValueDictionary()
+
+def get_chat_lock(chat_id):
+    chat_lock = chat_locks.get(chat_id)
+    if chat_lock is None:
+        chat_lock = chat_locks[chat_id] = asyncio.Lock()
+    return chat_lock
 
-def comm_with_backend(user_text):
+async def comm_with_backend(user_text, chat_id):
     print(f"Received message: {user_text}")
 
-    shared_dir = "/tmp2/yenhao-llm/RAG-chatbot"
-    w_path = shared_dir + "/msg.txt"
-    r_path = shared_dir + "/msg2.txt"
-    with open(w_path, "w") as f:
-        f.write(user_text)
-    
-    # 等待回應
-    while True:
-        if os.path.exists(r_path):
-            with open(r_path) as f:
-                reply = f.read()
-            if reply:  # 確保不是空字串
-                break
-    
-    os.remove(r_path)
+    # 透過 Unix socket 送給後端 (agent/script/chatbot_tgram.py)，等待時不阻塞 event loop
+    async with get_chat_lock(chat_id):
+        async with backend_slots:
+            reply = await async_request(user_text, DEFAULT_SOCKET_PATH, session=str(chat_id))
+
     print(reply)
     return reply
 
+async def stream_from_backend(user_text, chat_id):
+    """
+    Yield the accumulated reply each time the backend streams a new piece.
+    """
+    print(f"Received message: {user_text}")
+
+    reply = ""
+    async with get_chat_lock(chat_id):
+        async with backend_slots:
+            # chat id 作為多輪對話的 session
+            async for delta in async_stream_request(user_text, DEFAULT_SOCKET_PATH, session=str(chat_id)):
+                reply += delta
+                yield reply
+
+    print(reply)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Hello! 我是你的 Telegram Bot 🤖")
 
 async def close_rag(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_text = update.message.text
-    reply = comm_with_backend(user_text)
+    reply = await comm_with_backend(user_text, update.effective_chat.id)
     if reply == "Success":
         await update.message.reply_text("成功關閉 RAG")
     else:
@@ -47,20 +76,63 @@ async def close_rag(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def open_rag(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_text = update.message.text
-    reply = comm_with_backend(user_text)
+    reply = await comm_with_backend(user_text, update.effective_chat.id)
     if reply == "Success":
         await update.message.reply_text("成功開啟 RAG")
     else:
         await update.message.reply_text("開啟 RAG 失敗")
 
+async def reset_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_text = update.message.text
+    reply = await comm_with_backend(user_text, update.effective_chat.id)
+    if reply == "Success":
+        await update.message.reply_text("已清除對話紀錄")
+    else:
+        await update.message.reply_text("清除對話紀錄失敗")
+
 
 async def chat_with_chatbot(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with tracing.request("telegram", stream=STREAM_REPLY):
+        await reply_with_chatbot(update)
+
+async def reply_with_chatbot(update: Update):
     user_text = update.message.text
-    reply = comm_with_backend(user_text)
-    await update.message.reply_text(reply)
+    if not STREAM_REPLY:
+        with tracing.span("backend"):
+            reply = await comm_with_backend(user_text, update.effective_chat.id)
+        with tracing.span("telegram_send"):
+            await update.message.reply_text(reply)
+        return
+
+    # 第一段文字出現就先送出訊息，之後節流地編輯同一則訊息
+    message, shown, last_edit = None, "", 0.0
+    reply = ""
+    start = time.perf_counter()
+    async for reply in stream_from_backend(user_text, update.effective_chat.id):
+        if not reply.strip():
+            continue
+        if message is None:
+            tracing.record("backend_first_piece", time.perf_counter() - start)
+            with tracing.span("telegram_send"):
+                message = await update.message.reply_text(reply)
+            shown, last_edit = reply, time.monotonic()
+        elif time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+            with tracing.span("telegram_send"):
+                await message.edit_text(reply)
+            shown, last_edit = reply, time.monotonic()
+
+    with tracing.span("telegram_send"):
+        if message is None:
+            await update.message.reply_text(reply or "...")
+        elif reply != shown:
+            await message.edit_text(reply)
+
 
+if FRONTEND_METRICS_PORT:
+    tracing.start_metrics_server(FRONTEND_METRICS_PORT)
 
-app = Application.builder().token(TOKEN).build()
+# concurrent_updates: 讓不同使用者的 update 可以同時處理
+app = Application.builder().token(TOKEN).concurrent_updates(True).build()
 
 # "/start"
 app.add_handler(CommandHandler("start", start))
@@ -68,6 +140,8 @@ app.add_handler(CommandHandler("start", start))
 # "/close_rag"
 app.add_handler(CommandHandler("close_rag", close_rag))
 app.add_handler(CommandHandler("open_rag", open_rag))
+# "/reset": 清除多輪對話紀錄
+app.add_handler(CommandHandler("reset", reset_history))
 # Echo all text messages
 app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat_with_chatbot))
 
@@ -1,10 +1,59 @@
 import os
+import sys
 
 from langchain_community.vectorstores import FAISS
 from langchain.docstore.document import Document
+import faiss
 import json
 import torch
 
+# 與 agent 共用同一份 docstore 實作 (docs.jsonl + docs_offsets.npy + ids.json)
+repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+if repo_root not in sys.path:
+    sys.path.append(repo_root)
+from agent.utils.rag import doc_store
+
+LEGACY_DOCSTORE_NAME = "index.pkl"
+
+def save_index(vectorstore: FAISS, index_path: str):
+    # 不使用 save_local：docstore 以 JSON lines 存放，而非 pickle
+    os.makedirs(index_path, exist_ok=True)
+    faiss.write_index(vectorstore.index, os.path.join(index_path, "index.faiss"))
+    doc_store.write_doc_store(vectorstore.docstore, vectorstore.index_to_docstore_id, index_path)
+    # 舊格式的 pickle 已被取代
+    legacy_path = os.path.join(index_path, LEGACY_DOCSTORE_NAME)
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+def load_index(index_path: str, embedding_model, writable: bool = False) -> FAISS:
+    if not doc_store.has_doc_store(index_path):
+        # 舊版 index (index.faiss + index.pkl)
+        print(f"[!] {index_path} uses the pickled docstore; convert it with migrate_index")
+        return FAISS.load_local(index_path, embedding_model, allow_dangerous_deserialization=True)
+
+    ids = doc_store.load_ids(index_path)
+    if writable:
+        # 要新增文件時才把所有文件讀進記憶體
+        docstore = doc_store.load_docstore(index_path, ids)
+    else:
+        docstore = doc_store.LazyDocStore(index_path, ids)
+
+    return FAISS(
+        embedding_function=embedding_model,
+        index=faiss.read_index(os.path.join(index_path, "index.faiss")),
+        docstore=docstore,
+        index_to_docstore_id=dict(enumerate(ids)),
+    )
+
+def migrate_index(index_path: str, embedding_model) -> FAISS:
+    """
+    Rewrite an index saved with the pickled docstore (index.pkl) in the current format.
+    """
+    vectorstore = load_index(index_path, embedding_model, writable=True)
+    save_index(vectorstore, index_path)
+    print(f"[✓] Migrated {index_path}: {len(vectorstore.index_to_docstore_id)} documents")
+    return vectorstore
+
 def build_new_index(json_path: str, index_path: str, embedding_model):
     with open(json_path, "r", encoding="utf-8") as f:
         raw_data = json.load(f)
@@ -22,27 +71,25 @@ def build_new_index(json_path: str, index_path: str, embedding_model):
 
     vectorstore = FAISS.from_documents(docs, embedding_model)
 
-    os.makedirs(os.path.dirname(index_path), exist_ok=True)
-    vectorstore.save_local(index_path)
+    save_index(vectorstore, index_path)
     print(f"[✓] New index built and saved to {index_path}")
 
 
 def append_to_index(index_path: str, new_texts: list, embedding_model):
     new_docs = [Document(page_content=txt) for txt in new_texts]
 
-    vectorstore = FAISS.load_local(index_path, embeddings=embedding_model, allow_dangerous_deserialization=True)
+    vectorstore = load_index(index_path, embedding_model, writable=True)
     vectorstore.add_documents(new_docs)
-    vectorstore.save_local(index_path)
+    save_index(vectorstore, index_path)
     print(f"[+] Added {len(new_docs)} docs to existing index: {index_path}")
 
 def search_query(index_path: str, embedding_model, query: str, k: int = 5):
-    vectorstore = FAISS.load_local(index_path, embeddings=embedding_model, allow_dangerous_deserialization=True)
+    vectorstore = load_index(index_path, embedding_model)
 
     results = vectorstore.similarity_search(query, k=k)
-    
+
     print(f"\n🔍 Top-{k} results for query: \"{query}\"\n")
     for i, doc in enumerate(results):
         print(f"[{i+1}] {doc.page_content}\n{'-'*50}")
-    
-    return results
 
+    return results